@@ -0,0 +1,106 @@
+"""
+compare the deep history scans on the history values with and without the
+min/max header, the db is synced from a synthetic chain, then the history values
+are rewritten in the old format to measure the baseline.
+
+$ python -m benchmarks.bench_history_header --keys 100000 --blocks 1000
+"""
+
+import itertools
+import json
+import tempfile
+import time
+from pathlib import Path
+
+import click
+from versiondb import VersionDB
+from versiondb.metrics import Metrics
+from versiondb.sync import open_stream_file, sync_local
+from versiondb.utils import decode_history
+
+from .chain import DEFAULTS, ChainParams, store_names, write_chain
+from .suite import open_db
+
+
+def downgrade_history(db: VersionDB, batch_size: int = 10000) -> int:
+    "rewrite the history values in the format without header"
+    it = db.history.iteritems()
+    it.seek_to_first()
+    count = 0
+    while True:
+        chunk = list(itertools.islice(it, batch_size))
+        if not chunk:
+            break
+        with db.write_batches() as batches:
+            for k, v in chunk:
+                batches.history.put(k, decode_history(v).serialize())
+        count += len(chunk)
+    return count
+
+
+def bench_scans(db: VersionDB, stores, versions, limit: int) -> dict:
+    db.metrics = Metrics()
+    begin = time.perf_counter()
+    count = 0
+    for version in versions:
+        for store in stores:
+            it = db.iterator(version, store)
+            count += sum(1 for _ in itertools.islice(it, limit))
+    elapsed = time.perf_counter() - begin
+    deserialized = db.metrics.counters.get("iter_bitmaps_deserialized", 0)
+    db.metrics = None
+    return {
+        "items": count,
+        "seconds": elapsed,
+        "items_per_sec": count / elapsed if elapsed > 0 else 0,
+        "bitmaps_deserialized": deserialized,
+    }
+
+
+def run(params: ChainParams, backend: str, limit: int, workdir: Path) -> dict:
+    chain_dir = workdir / "chain"
+    write_chain(chain_dir, params)
+    db = open_db(workdir / "db", backend)
+    genesis = open_stream_file(chain_dir / "block-0-data")
+    db.put(0, (item.to_kvpair() for item in genesis))
+    sync_local(chain_dir, db)
+
+    latest = db.latest_version()
+    # deep history, most of the keys have no change before
+    versions = [max(0, latest // 10), max(0, latest // 2)]
+    stores = store_names(params)
+    after = bench_scans(db, stores, versions, limit)
+    downgrade_history(db)
+    before = bench_scans(db, stores, versions, limit)
+    return {
+        "params": params._asdict(),
+        "backend": backend,
+        "versions": versions,
+        "before": before,
+        "after": after,
+        "speedup": before["seconds"] / after["seconds"] if after["seconds"] else 0,
+    }
+
+
+@click.command()
+@click.option("--keys", default=DEFAULTS.keys)
+@click.option("--stores", default=DEFAULTS.stores)
+@click.option("--blocks", default=DEFAULTS.blocks)
+@click.option("--churn", default=DEFAULTS.churn)
+@click.option("--skew", default=DEFAULTS.skew)
+@click.option("--seed", default=DEFAULTS.seed)
+@click.option(
+    "--backend",
+    type=click.Choice(["rocksdb", "rocksdb-cf", "lmdb"]),
+    default="rocksdb",
+)
+@click.option("--scan-limit", default=100000, help="max items per iterator scan")
+def main(backend, scan_limit, **kwargs):
+    params = ChainParams(**kwargs)
+    with tempfile.TemporaryDirectory() as tmp:
+        result = run(params, backend, scan_limit, Path(tmp))
+    print(json.dumps(result, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+"""
+compare the batched read-modify-write in `VersionDB.put_batch` with the
+original point read per key implementation.
+
+$ python benchmarks/bench_put_batch.py --writes 10000 --blocks 20
+"""
+
+import random
+import tempfile
+import time
+from pathlib import Path
+
+import click
+import rocksdb
+from versiondb import KVPair, VersionDB
+from versiondb.utils import (changeset_key, encode_stdint64, full_key,
+                             set_bitmap)
+from versiondb.versiondb import LATEST_VERSION_KEY
+
+
+def put_batch_pointwise(db: VersionDB, version, change_set):
+    "the original implementation, one point read per key on each store"
+    plain_batch = rocksdb.WriteBatch()
+    history_batch = rocksdb.WriteBatch()
+    changeset_batch = rocksdb.WriteBatch()
+    for item in change_set:
+        key = full_key(item.store_key, item.key)
+        original = db.plain.get(key)
+        if original == item.value:
+            continue
+        bm = set_bitmap(db.history, key, version)
+        history_batch.put(key, bm.serialize())
+        if original is not None:
+            changeset_batch.put(changeset_key(version, key), original)
+        if item.value is None:
+            plain_batch.delete(key)
+        else:
+            plain_batch.put(key, item.value)
+    plain_batch.put(LATEST_VERSION_KEY, encode_stdint64(version))
+    db.changeset.write(changeset_batch)
+    db.history.write(history_batch)
+    db.plain.write(plain_batch)
+
+
+def gen_blocks(keys, writes, blocks, seed):
+    rnd = random.Random(seed)
+    genesis = [KVPair("evm", b"key-%08d" % i, b"genesis") for i in range(keys)]
+    change_sets = [
+        [
+            KVPair("evm", b"key-%08d" % rnd.randrange(keys), b"%d-%d" % (v, i))
+            for i in range(writes)
+        ]
+        for v in range(1, blocks + 1)
+    ]
+    return genesis, change_sets
+
+
+def run(put, genesis, change_sets):
+    with tempfile.TemporaryDirectory() as tmp:
+        db = VersionDB.open_rocksdb(Path(tmp))
+        db.put(0, genesis)
+        begin = time.perf_counter()
+        for v, change_set in enumerate(change_sets, 1):
+            put(db, v, change_set)
+        return (time.perf_counter() - begin) / len(change_sets)
+
+
+@click.command()
+@click.option("--keys", default=200000, help="number of keys in genesis state")
+@click.option("--writes", default=10000, help="number of writes per block")
+@click.option("--blocks", default=20)
+@click.option("--seed", default=0)
+def main(keys, writes, blocks, seed):
+    genesis, change_sets = gen_blocks(keys, writes, blocks, seed)
+    pointwise = run(put_batch_pointwise, genesis, change_sets)
+    batched = run(VersionDB.put_batch, genesis, change_sets)
+    print(f"pointwise: {pointwise * 1000:.2f}ms/block")
+    print(f"batched:   {batched * 1000:.2f}ms/block")
+    print(f"speedup:   {pointwise / batched:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+"""
+load generator for the query server, run it against a server serving a db
+synced from `benchmarks.chain`:
+
+$ versiondb serve --db /tmp/db --unix /tmp/versiondb.sock
+$ python -m benchmarks.bench_server --address /tmp/versiondb.sock --keys 100000
+"""
+
+import asyncio
+import json
+import random
+import time
+
+import click
+
+from .chain import DEFAULTS, key_name, store_names
+from .suite import percentiles
+
+
+async def connect(address: str):
+    if ":" in address and not address.startswith("/"):
+        host, port = address.rsplit(":", 1)
+        return await asyncio.open_connection(host, int(port))
+    return await asyncio.open_unix_connection(address)
+
+
+async def worker(address, requests, stores, keys, version, seed, latencies):
+    rnd = random.Random(seed)
+    reader, writer = await connect(address)
+    try:
+        for i in range(requests):
+            req = {
+                "id": i,
+                "method": "get",
+                "params": {
+                    "version": version,
+                    "store_key": rnd.choice(stores),
+                    "key": key_name(rnd.randrange(keys)).hex(),
+                },
+            }
+            begin = time.perf_counter()
+            writer.write(json.dumps(req).encode() + b"\n")
+            await writer.drain()
+            msg = json.loads(await reader.readline())
+            latencies.append(time.perf_counter() - begin)
+            assert "error" not in msg, msg["error"]
+    finally:
+        writer.close()
+
+
+async def run(address, connections, requests, stores, keys, version, seed):
+    latencies = []
+    begin = time.perf_counter()
+    await asyncio.gather(
+        *(
+            worker(address, requests, stores, keys, version, seed + i, latencies)
+            for i in range(connections)
+        )
+    )
+    elapsed = time.perf_counter() - begin
+    return {
+        "connections": connections,
+        "requests": len(latencies),
+        "seconds": elapsed,
+        "requests_per_sec": len(latencies) / elapsed if elapsed > 0 else 0,
+        "latency": percentiles(latencies),
+    }
+
+
+@click.command()
+@click.option("--address", required=True, help="host:port or unix socket path")
+@click.option("--connections", default=16)
+@click.option("--requests", default=1000, help="requests per connection")
+@click.option("--keys", default=DEFAULTS.keys, help="same as the chain generated")
+@click.option("--stores", default=DEFAULTS.stores, help="same as the chain generated")
+@click.option("--version", default=None, type=click.INT)
+@click.option("--seed", default=0)
+def main(address, connections, requests, keys, stores, version, seed):
+    names = store_names(DEFAULTS._replace(stores=stores))
+    result = asyncio.run(
+        run(address, connections, requests, names, keys, version, seed)
+    )
+    print(json.dumps(result, indent=2))
+
+
+if __name__ == "__main__":
+    main()
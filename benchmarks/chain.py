@@ -0,0 +1,106 @@
+"""
+synthetic chain generator, write the genesis state and the changesets in the
+file streamer format: block-0-data is the genesis, block-N-data are the blocks.
+
+$ python -m benchmarks.chain --keys 100000 --blocks 1000 /tmp/chain
+"""
+
+import random
+from pathlib import Path
+from typing import List, NamedTuple
+
+import click
+from versiondb import KVPair
+from versiondb.sync import StoreKVPairs, encode_stream_file
+
+
+class ChainParams(NamedTuple):
+    # number of keys in genesis state of each store
+    keys: int = 10000
+    stores: int = 3
+    blocks: int = 100
+    # fraction of the keys written in each block
+    churn: float = 0.01
+    # fraction of the writes which are deletions
+    deletes: float = 0.05
+    # >1 concentrates the writes on fewer hot keys, 1 is uniform
+    skew: float = 2.0
+    value_size: int = 32
+    seed: int = 0
+
+
+DEFAULTS = ChainParams()
+
+
+def store_names(params: ChainParams) -> List[str]:
+    return [f"store{i}" for i in range(params.stores)]
+
+
+def key_name(i: int) -> bytes:
+    return b"key-%010d" % i
+
+
+class Chain:
+    def __init__(self, params: ChainParams):
+        self.params = params
+        self.rnd = random.Random(params.seed)
+
+    def value(self) -> bytes:
+        return self.rnd.randbytes(self.params.value_size)
+
+    def pick_key(self) -> int:
+        # the new keys are allocated beyond the genesis range occasionally
+        n = self.params.keys
+        return int(n * (self.rnd.random() ** self.params.skew) * 1.1)
+
+    def genesis(self) -> List[KVPair]:
+        return [
+            KVPair(store, key_name(i), self.value())
+            for store in store_names(self.params)
+            for i in range(self.params.keys)
+        ]
+
+    def block(self) -> List[KVPair]:
+        params = self.params
+        writes = max(1, int(params.keys * params.churn))
+        result = []
+        for store in store_names(params):
+            for _ in range(writes):
+                key = key_name(self.pick_key())
+                if self.rnd.random() < params.deletes:
+                    result.append(KVPair(store, key, None))
+                else:
+                    result.append(KVPair(store, key, self.value()))
+        return result
+
+
+def write_chain(path: Path, params: ChainParams):
+    path.mkdir(parents=True, exist_ok=True)
+    chain = Chain(params)
+
+    def write(version, pairs):
+        (path / f"block-{version}-data").write_bytes(
+            encode_stream_file(StoreKVPairs.from_kvpair(p) for p in pairs)
+        )
+
+    write(0, chain.genesis())
+    for version in range(1, params.blocks + 1):
+        write(version, chain.block())
+
+
+@click.command()
+@click.option("--keys", default=DEFAULTS.keys)
+@click.option("--stores", default=DEFAULTS.stores)
+@click.option("--blocks", default=DEFAULTS.blocks)
+@click.option("--churn", default=DEFAULTS.churn)
+@click.option("--deletes", default=DEFAULTS.deletes)
+@click.option("--skew", default=DEFAULTS.skew)
+@click.option("--value-size", default=DEFAULTS.value_size)
+@click.option("--seed", default=DEFAULTS.seed)
+@click.argument("path", type=click.Path())
+def main(path, **kwargs):
+    write_chain(Path(path), ChainParams(**kwargs))
+
+
+if __name__ == "__main__":
+    main()
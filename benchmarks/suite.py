@@ -0,0 +1,163 @@
+"""
+reproducible benchmark suite, generate a synthetic chain, then measure:
+
+- sync_local ingest speed in blocks/s
+- get latency percentiles at the latest, a recent and a deep history version
+- forward and reverse iterator throughput at the same versions
+
+the results are printed as json, so different runs can be compared.
+
+$ python -m benchmarks.suite --keys 100000 --blocks 1000 --output result.json
+"""
+
+import itertools
+import json
+import platform
+import random
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import click
+import versiondb
+from versiondb import VersionDB
+from versiondb.sync import open_stream_file, sync_local
+
+from .chain import DEFAULTS, ChainParams, key_name, store_names, write_chain
+
+
+def percentiles(samples) -> dict:
+    "latencies in microseconds"
+    samples = sorted(samples)
+
+    def at(p):
+        return samples[min(len(samples) - 1, int(len(samples) * p))] * 1e6
+
+    return {
+        "p50": at(0.5),
+        "p90": at(0.9),
+        "p99": at(0.99),
+        "max": samples[-1] * 1e6,
+    }
+
+
+def query_versions(db: VersionDB) -> dict:
+    latest = db.latest_version()
+    return {
+        "latest": None,
+        "recent": max(0, latest - 10),
+        "deep": max(0, latest // 10),
+    }
+
+
+def bench_sync(chain_dir: Path, db: VersionDB, workers: int) -> dict:
+    genesis = open_stream_file(chain_dir / "block-0-data")
+    db.put(0, (item.to_kvpair() for item in genesis))
+
+    begin = time.perf_counter()
+    count = sync_local(chain_dir, db, workers=workers)
+    elapsed = time.perf_counter() - begin
+    return {
+        "blocks": count,
+        "seconds": elapsed,
+        "blocks_per_sec": count / elapsed if elapsed > 0 else 0,
+    }
+
+
+def bench_get(db: VersionDB, params: ChainParams, samples: int) -> dict:
+    rnd = random.Random(params.seed)
+    stores = store_names(params)
+    result = {}
+    for label, version in query_versions(db).items():
+        latencies = []
+        for _ in range(samples):
+            store = rnd.choice(stores)
+            key = key_name(rnd.randrange(params.keys))
+            begin = time.perf_counter()
+            db.get(version, store, key)
+            latencies.append(time.perf_counter() - begin)
+        result[label] = percentiles(latencies)
+    return result
+
+
+def bench_iterator(db: VersionDB, params: ChainParams, limit: int) -> dict:
+    store = store_names(params)[0]
+    result = {}
+    for label, version in query_versions(db).items():
+        for reverse in (False, True):
+            begin = time.perf_counter()
+            it = db.iterator(version, store, reverse=reverse)
+            count = sum(1 for _ in itertools.islice(it, limit))
+            elapsed = time.perf_counter() - begin
+            name = f"{label}-{'reverse' if reverse else 'forward'}"
+            result[name] = {
+                "items": count,
+                "seconds": elapsed,
+                "items_per_sec": count / elapsed if elapsed > 0 else 0,
+            }
+    return result
+
+
+def open_db(path: Path, backend: str) -> VersionDB:
+    if backend == "lmdb":
+        return VersionDB.open_lmdb(path)
+    layout = "cf" if backend == "rocksdb-cf" else "separate"
+    return VersionDB.open_rocksdb(path, layout=layout)
+
+
+def run(params: ChainParams, backend, workers, samples, scan_limit, workdir) -> dict:
+    chain_dir = workdir / "chain"
+    begin = time.perf_counter()
+    write_chain(chain_dir, params)
+    generate = time.perf_counter() - begin
+
+    db = open_db(workdir / "db", backend)
+    return {
+        "meta": {
+            "versiondb": versiondb.__version__,
+            "python": sys.version.split()[0],
+            "platform": platform.platform(),
+            "backend": backend,
+            "workers": workers,
+            "params": params._asdict(),
+            "generate_seconds": generate,
+        },
+        "sync": bench_sync(chain_dir, db, workers),
+        "get": bench_get(db, params, samples),
+        "iterator": bench_iterator(db, params, scan_limit),
+    }
+
+
+@click.command()
+@click.option("--keys", default=DEFAULTS.keys)
+@click.option("--stores", default=DEFAULTS.stores)
+@click.option("--blocks", default=DEFAULTS.blocks)
+@click.option("--churn", default=DEFAULTS.churn)
+@click.option("--deletes", default=DEFAULTS.deletes)
+@click.option("--skew", default=DEFAULTS.skew)
+@click.option("--value-size", default=DEFAULTS.value_size)
+@click.option("--seed", default=DEFAULTS.seed)
+@click.option(
+    "--backend",
+    type=click.Choice(["rocksdb", "rocksdb-cf", "lmdb"]),
+    default="rocksdb",
+)
+@click.option("--workers", default=0, help="sync_local worker processes")
+@click.option("--samples", default=10000, help="get calls per version")
+@click.option("--scan-limit", default=10000, help="max items per iterator scan")
+@click.option("--workdir", type=click.Path(), help="keep the chain and db there")
+@click.option("--output", type=click.File("w"), default="-")
+def main(backend, workers, samples, scan_limit, workdir, output, **kwargs):
+    params = ChainParams(**kwargs)
+    if workdir:
+        result = run(params, backend, workers, samples, scan_limit, Path(workdir))
+    else:
+        with tempfile.TemporaryDirectory() as tmp:
+            result = run(params, backend, workers, samples, scan_limit, Path(tmp))
+    json.dump(result, output, indent=2)
+    output.write("\n")
+
+
+if __name__ == "__main__":
+    main()
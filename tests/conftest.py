@@ -3,17 +3,24 @@ import rocksdb
 from versiondb import KVPair, VersionDB
 
 
-@pytest.fixture(scope="function")
-def testdb(tmp_path):
-    store = VersionDB(
-        rocksdb.DB(str(tmp_path / "plain.db"), rocksdb.Options(create_if_missing=True)),
-        rocksdb.DB(
-            str(tmp_path / "changeset.db"), rocksdb.Options(create_if_missing=True)
-        ),
-        rocksdb.DB(
-            str(tmp_path / "history.db"), rocksdb.Options(create_if_missing=True)
-        ),
-    )
+@pytest.fixture(scope="function", params=["rocksdb", "rocksdb-cf", "lmdb"])
+def testdb(request, tmp_path):
+    if request.param == "lmdb":
+        store = VersionDB.open_lmdb(tmp_path / "versiondb.lmdb")
+    elif request.param == "rocksdb-cf":
+        store = VersionDB.open_rocksdb(tmp_path, layout="cf")
+    else:
+        store = VersionDB(
+            rocksdb.DB(
+                str(tmp_path / "plain.db"), rocksdb.Options(create_if_missing=True)
+            ),
+            rocksdb.DB(
+                str(tmp_path / "changeset.db"), rocksdb.Options(create_if_missing=True)
+            ),
+            rocksdb.DB(
+                str(tmp_path / "history.db"), rocksdb.Options(create_if_missing=True)
+            ),
+        )
     init_test_db(store)
     return store
 
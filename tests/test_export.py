@@ -0,0 +1,48 @@
+import functools
+
+import pytest
+from versiondb import KVPair, VersionDB
+from versiondb.export import MANIFEST, export_state, import_state, split_points
+
+
+def write_test_state(db: VersionDB):
+    db.put(0, [KVPair("evm", b"key%03d" % i, b"0") for i in range(100)])
+    for v in range(1, 5):
+        db.put(
+            v,
+            [KVPair("evm", b"key%03d" % i, b"%d" % v) for i in range(v, 100, 7)]
+            + [KVPair("evm", b"key%03d" % v, None)],
+        )
+
+
+@pytest.mark.parametrize("workers", [0, 2])
+def test_export_import(tmp_path, workers):
+    db = VersionDB.open_lmdb(tmp_path / "src")
+    write_test_state(db)
+    assert 3 == len(split_points(db, "evm", 4))
+
+    out = tmp_path / "export"
+    manifest = export_state(
+        db,
+        out,
+        ["evm"],
+        version=2,
+        ranges=4,
+        workers=workers,
+        opener=functools.partial(VersionDB.open_lmdb, tmp_path / "src", read_only=True),
+        chunk_size=10,
+    )
+    assert 2 == manifest["version"]
+    expected = list(db.iterator(2, "evm"))
+    assert len(expected) == sum(c["count"] for c in manifest["stores"]["evm"])
+
+    dst = VersionDB.open_lmdb(tmp_path / "dst")
+    assert len(expected) == import_state(dst, out)
+    assert 0 == dst.latest_version()
+    assert expected == list(dst.iterator(None, "evm"))
+
+    # corrupted chunk
+    (out / manifest["stores"]["evm"][0]["file"]).write_bytes(b"corrupted")
+    with pytest.raises(ValueError, match="checksum mismatch"):
+        import_state(VersionDB.open_lmdb(tmp_path / "dst2"), out)
+    assert (out / MANIFEST).exists()
@@ -0,0 +1,85 @@
+import asyncio
+import threading
+from contextlib import contextmanager
+
+import pytest
+from versiondb.client import Client, ServerError
+from versiondb.server import Server
+
+
+@contextmanager
+def serve(db, path, **kwargs):
+    "run the server in a thread, shut it down cleanly on exit"
+    loop = asyncio.new_event_loop()
+    server = loop.run_until_complete(Server(db, **kwargs).start(unix=path))
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+    try:
+        yield
+    finally:
+
+        async def shutdown():
+            server.close()
+            await server.wait_closed()
+            # the handlers of the open connections
+            tasks = [t for t in asyncio.all_tasks() if t is not asyncio.current_task()]
+            for t in tasks:
+                t.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+        asyncio.run_coroutine_threadsafe(shutdown(), loop).result()
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join()
+        loop.close()
+
+
+@pytest.fixture
+def client(testdb, tmp_path):
+    path = str(tmp_path / "versiondb.sock")
+    with serve(testdb, path, page_size=2):
+        with Client(path) as c:
+            yield c
+
+
+def test_server(testdb, client):
+    assert testdb.latest_version() == client.latest_version()
+    for version in [None, 0, 2]:
+        assert testdb.get(version, "staking", b"key1") == client.get(
+            version, "staking", b"key1"
+        )
+        keys = [b"modify-in-block2", b"not-exist", b"add-in-block2"]
+        assert testdb.multi_get(version, "evm", keys) == client.multi_get(
+            version, "evm", keys
+        )
+        for reverse in [False, True]:
+            assert list(testdb.iterator(version, "evm", reverse=reverse)) == list(
+                client.iterator(version, "evm", reverse=reverse)
+            )
+        assert list(testdb.iterator(version, "evm"))[:3] == list(
+            client.iterator(version, "evm", limit=3)
+        )
+
+    pairs = [("staking", b"key1"), ("evm", b"modify-in-block2")]
+    assert testdb.multi_get_stores(0, pairs) == client.multi_get_stores(0, pairs)
+
+    with pytest.raises(ServerError):
+        client.call("not-exist")
+    # the connection is still usable after error
+    assert testdb.latest_version() == client.latest_version()
+
+
+def test_large_request(testdb, tmp_path):
+    path = str(tmp_path / "versiondb.sock")
+    keys = [b"k" * 50 + b"%03d" % i for i in range(1000)] + [b"modify-in-block2"]
+    with serve(testdb, path, line_limit=64 * 1024):
+        with Client(path) as client:
+            # over the limit of the line, the connection is kept
+            with pytest.raises(ServerError, match="exceeds"):
+                client.multi_get(None, "evm", keys)
+            assert testdb.latest_version() == client.latest_version()
+
+    with serve(testdb, path):
+        with Client(path) as client:
+            assert testdb.multi_get(None, "evm", keys) == client.multi_get(
+                None, "evm", keys
+            )
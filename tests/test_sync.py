@@ -0,0 +1,138 @@
+import threading
+import time
+
+import pytest
+from versiondb import KVPair
+from versiondb.metrics import Metrics
+from versiondb.sync import (StoreKVPairs, block_ready, decode_stream_file,
+                            encode_stream_file, follow, newest_block,
+                            open_stream_file, prune_loop, sync_local)
+
+
+def write_block_files(path, change_sets, start=1):
+    for i, change_set in enumerate(change_sets):
+        (path / f"block-{start + i}-data").write_bytes(
+            encode_stream_file(StoreKVPairs.from_kvpair(p) for p in change_set)
+        )
+
+
+@pytest.mark.parametrize("workers", [0, 2])
+def test_sync_local(testdb, tmp_path, workers):
+    streamer = tmp_path / "streamer"
+    streamer.mkdir()
+    write_block_files(
+        streamer,
+        [
+            [KVPair("evm", b"add-in-block5", b"1")],
+            [KVPair("evm", b"add-in-block5", None), KVPair("evm", b"k", b"v")],
+        ],
+        start=testdb.latest_version() + 1,
+    )
+
+    assert 2 == sync_local(streamer, testdb, workers=workers, prefetch=3)
+    assert 6 == testdb.latest_version()
+    assert b"1" == testdb.get(5, "evm", b"add-in-block5")
+    assert testdb.get(6, "evm", b"add-in-block5") is None
+    assert b"v" == testdb.get(None, "evm", b"k")
+
+    # nothing more to sync
+    assert 0 == sync_local(streamer, testdb, workers=workers)
+
+
+def test_open_stream_file(tmp_path):
+    pairs = [
+        KVPair("evm", b"key%d" % i, b"value%d" % i if i % 3 else None)
+        for i in range(100)
+    ]
+    data = encode_stream_file(StoreKVPairs.from_kvpair(p) for p in pairs)
+    path = tmp_path / "block-1-data"
+    path.write_bytes(data)
+
+    assert pairs == [item.to_kvpair() for item in open_stream_file(path)]
+    assert pairs == [item.to_kvpair() for item in decode_stream_file(data)]
+
+    with pytest.raises(FileNotFoundError):
+        open_stream_file(tmp_path / "block-2-data")
+
+    path.write_bytes(data[:-1])
+    with pytest.raises(AssertionError, match="incomplete file"):
+        list(open_stream_file(path))
+
+
+def wait_until(cond, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not cond():
+        assert time.monotonic() < deadline, "timeout"
+        time.sleep(0.01)
+
+
+@pytest.mark.parametrize("workers", [0, 2])
+def test_follow(testdb, tmp_path, workers):
+    streamer = tmp_path / "streamer"
+    streamer.mkdir()
+    start = testdb.latest_version() + 1
+    testdb.metrics = Metrics()
+    stop = threading.Event()
+    result = []
+    t = threading.Thread(
+        target=lambda: result.append(
+            follow(
+                streamer,
+                testdb,
+                workers=workers,
+                poll_interval=0.05,
+                stop=stop,
+                metrics_file=tmp_path / "versiondb.prom",
+            )
+        )
+    )
+    t.start()
+    try:
+        data = encode_stream_file(
+            [StoreKVPairs.from_kvpair(KVPair("evm", b"k", b"v1"))]
+        )
+        # partially written file is not ready
+        path = streamer / f"block-{start}-data"
+        path.write_bytes(data[:-1])
+        assert not block_ready(path)
+        time.sleep(0.2)
+        assert start - 1 == testdb.latest_version()
+
+        path.write_bytes(data)
+        wait_until(lambda: testdb.latest_version() == start)
+        assert b"v1" == testdb.get(None, "evm", b"k")
+
+        write_block_files(
+            streamer,
+            [[KVPair("evm", b"k", b"v%d" % i)] for i in range(2, 5)],
+            start=start + 1,
+        )
+        wait_until(lambda: testdb.latest_version() == start + 3)
+        wait_until(lambda: testdb.metrics.gauges["sync_lag_blocks"] == 0)
+        prom = tmp_path / "versiondb.prom"
+        wait_until(
+            lambda: f"versiondb_sync_latest_version {start + 3}\n" in prom.read_text()
+        )
+    finally:
+        stop.set()
+        t.join()
+    assert [4] == result
+    assert start + 3 == newest_block(streamer, start - 1)
+
+
+def test_prune_loop(testdb):
+    stop = threading.Event()
+    result = []
+    t = threading.Thread(
+        target=lambda: result.append(prune_loop(testdb, 2, 0.01, stop))
+    )
+    t.start()
+    try:
+        wait_until(lambda: testdb.pruned_version() == 2)
+        testdb.put(5, [KVPair("evm", b"k", b"v")])
+        wait_until(lambda: testdb.pruned_version() == 3)
+    finally:
+        stop.set()
+        t.join()
+    assert result[0] > 0
+    assert b"v" == testdb.get(None, "evm", b"k")
@@ -1,4 +1,16 @@
-from versiondb import KVPair, __version__
+import gc
+
+import pytest
+from versiondb import (Change, KeyChange, KVPair, VersionDB,
+                       VersionPrunedError, __version__)
+from versiondb.metrics import Metrics
+from versiondb.migrate import migrate_to_cf, reencode_keys
+from versiondb.options import PROFILES, resolve_config
+from versiondb.utils import decode_history, full_key, history_bounds
+from versiondb.verify import compare_dbs, store_keys
+from versiondb.versiondb import CHANGESET_CREATIONS_KEY, CHECKPOINT_MANIFEST
+
+from .conftest import init_test_db
 
 
 def test_version():
@@ -99,3 +111,519 @@ def test_iterator(testdb):
     i = len(exp_evm)
     assert exp_evm[-1][:-1] == list(testdb.iterator(i, "evm")), f"block-{i}"
     assert exp_evm[-1] == list(testdb.iterator(i - 1, "evm")), f"block-{i-1}"
+
+
+def test_duplicated_keys_in_block(testdb):
+    v = testdb.latest_version() + 1
+    testdb.put(
+        v,
+        [
+            # modified and then reverted in the same block
+            KVPair("evm", b"z-genesis-only", b"3"),
+            KVPair("evm", b"z-genesis-only", b"2"),
+            KVPair("evm", b"dup", b"1"),
+            KVPair("evm", b"dup", b"2"),
+        ],
+    )
+    assert b"2" == testdb.get(None, "evm", b"z-genesis-only")
+    assert b"2" == testdb.get(v - 1, "evm", b"z-genesis-only")
+    assert b"2" == testdb.get(None, "evm", b"dup")
+    assert testdb.get(v - 1, "evm", b"dup") is None
+
+    testdb.put(
+        v + 1,
+        [
+            KVPair("evm", b"dup", b"3"),
+            KVPair("evm", b"dup", None),
+        ],
+    )
+    assert testdb.get(None, "evm", b"dup") is None
+    assert b"2" == testdb.get(v, "evm", b"dup")
+    assert testdb.get(v - 1, "evm", b"dup") is None
+
+
+def test_bitmap_cache(tmp_path):
+    db = VersionDB.open_rocksdb(tmp_path, cache_size=2)
+    init_test_db(db)
+
+    assert b"1" == db.get(0, "evm", b"re-add-in-block3")
+    assert b"1" == db.get(0, "evm", b"re-add-in-block3")
+    assert b"value1" == db.get(0, "staking", b"key1")
+    assert b"1" == db.get(0, "evm", b"modify-in-block2")
+    stats = db.cache_stats()
+    assert stats["size"] == 2
+    assert (stats["hits"], stats["misses"]) == (1, 3)
+
+    # the write invalidates the cached bitmap
+    db.put(5, [KVPair("evm", b"modify-in-block2", b"3")])
+    assert 5 == db.latest_version()
+    assert b"2" == db.get(4, "evm", b"modify-in-block2")
+    assert b"3" == db.get(None, "evm", b"modify-in-block2")
+
+
+def test_multi_get(testdb):
+    keys = [
+        b"delete-in-block2",
+        b"re-add-in-block3",
+        b"z-genesis-only",
+        b"modify-in-block2",
+        b"add-in-block2",
+        b"not-exist",
+        b"z-genesis-only",
+    ]
+    for version in [None, 0, 1, 2, 3, 4]:
+        assert [testdb.get(version, "evm", key) for key in keys] == testdb.multi_get(
+            version, "evm", keys
+        ), f"block-{version}"
+
+    pairs = [("staking", b"key1"), ("evm", b"modify-in-block2"), ("staking", b"key2")]
+    assert [b"value1", b"1", None] == testdb.multi_get_stores(0, pairs)
+    assert [b"value2", b"2", None] == testdb.multi_get_stores(None, pairs)
+
+
+def test_migrate_cf(tmp_path):
+    src = VersionDB.open_rocksdb(tmp_path / "src")
+    init_test_db(src)
+    # release the lock of the writer
+    del src
+    gc.collect()
+    counts = migrate_to_cf(tmp_path / "src", tmp_path / "dst")
+    assert counts["plain"] > 0
+
+    src = VersionDB.open_rocksdb(tmp_path / "src", mode="readonly")
+
+    dst = VersionDB.open_rocksdb(tmp_path / "dst")
+    assert dst.shared_db is not None
+    assert src.latest_version() == dst.latest_version()
+    for version in range(src.latest_version() + 1):
+        for store_key in ["evm", "staking"]:
+            assert list(src.iterator(version, store_key)) == list(
+                dst.iterator(version, store_key)
+            )
+
+
+def test_iterator_snapshot(testdb):
+    keys = [b"key-%03d" % i for i in range(100)]
+    testdb.put(5, [KVPair("bank", key, b"1") for key in keys])
+    testdb.put(6, [KVPair("bank", key, b"2") for key in keys[::2]])
+    exp5 = [(key, b"1") for key in keys]
+    exp6 = [(key, b"2" if i % 2 == 0 else b"1") for i, key in enumerate(keys)]
+
+    it = testdb.iterator(5, "bank")
+    it_reverse = testdb.iterator(5, "bank", reverse=True)
+    # the writes after the iterators created are not visible
+    testdb.put(7, [KVPair("bank", key, None) for key in keys])
+    assert exp5 == list(it)
+    assert list(reversed(exp5)) == list(it_reverse)
+    assert exp6 == list(testdb.iterator(6, "bank"))
+    assert [] == list(testdb.iterator(7, "bank"))
+
+
+@pytest.mark.parametrize("layout", ["separate", "cf"])
+@pytest.mark.parametrize("profile", ["ingest", "query", "archive"])
+def test_tuning_profiles(tmp_path, layout, profile):
+    db = VersionDB.open_rocksdb(
+        tmp_path,
+        layout=layout,
+        profile=profile,
+        tuning={"block_cache_size": 8 << 20, "stores": {"history": {"bloom_bits": 12}}},
+    )
+    init_test_db(db)
+    assert b"value1" == db.get(0, "staking", b"key1")
+    assert [(b"key1", b"value2"), (b"key1/subkey", b"value1")] == list(
+        db.iterator(None, "staking")
+    )
+    assert [(b"key1/subkey", b"value1"), (b"key1", b"value2")] == list(
+        db.iterator(None, "staking", reverse=True)
+    )
+
+
+def test_resolve_config():
+    config = resolve_config(
+        "query", {"profile": "archive", "stores": {"plain": {"bloom_bits": 16}}}
+    )
+    assert config["stores"]["plain"] == {"bloom_bits": 16, "compression": "zstd"}
+    assert config["stores"]["history"] == PROFILES["archive"]["stores"]["history"]
+    assert "profile" not in config
+
+
+@pytest.mark.parametrize("backend", ["rocksdb", "lmdb"])
+def test_sharded_history(tmp_path, backend):
+    if backend == "lmdb":
+        db = VersionDB.open_lmdb(tmp_path, history_shard_size=3)
+    else:
+        db = VersionDB.open_rocksdb(tmp_path, history_shard_size=3)
+
+    # hot key is changed in every block, the sub key in every other block.
+    db.put(0, [KVPair("evm", b"hot", b"0"), KVPair("evm", b"hot/sub", b"0")])
+    for v in range(1, 21):
+        change_set = [KVPair("evm", b"hot", b"%d" % v)]
+        if v % 2 == 0:
+            change_set.append(KVPair("evm", b"hot/sub", b"%d" % v))
+        db.put(v, change_set)
+
+    for v in range(21):
+        hot = b"%d" % v
+        sub = b"%d" % (v - v % 2)
+        assert hot == db.get(v, "evm", b"hot"), f"block-{v}"
+        assert sub == db.get(v, "evm", b"hot/sub"), f"block-{v}"
+        assert [hot, sub] == db.multi_get(v, "evm", [b"hot", b"hot/sub"])
+        assert [(b"hot", hot), (b"hot/sub", sub)] == list(db.iterator(v, "evm"))
+
+    expected = [KeyChange(v, b"%d" % (v - 2), b"%d" % v) for v in range(2, 21, 2)]
+    assert expected == list(db.key_history("evm", b"hot/sub"))
+    assert expected[3:6] == list(db.key_history("evm", b"hot/sub", 7, 13))
+
+
+@pytest.mark.parametrize("layout", ["separate", "cf"])
+def test_merge_history(tmp_path, layout):
+    db1 = VersionDB.open_rocksdb(tmp_path / "db1", layout=layout)
+    db2 = VersionDB.open_rocksdb(tmp_path / "db2", layout=layout, merge_history=True)
+    init_test_db(db1)
+    init_test_db(db2)
+    assert [] == list(compare_dbs(db1, db2, ["evm", "staking"]))
+
+    db2.put(5, [KVPair("evm", b"z-genesis-only", b"3")])
+    assert list(compare_dbs(db1, db2, ["evm", "staking"]))
+    db1.put(5, [KVPair("evm", b"z-genesis-only", b"3")])
+    assert [] == list(compare_dbs(db1, db2, ["evm", "staking"]))
+
+
+@pytest.mark.parametrize("backend", ["rocksdb", "lmdb"])
+@pytest.mark.parametrize("history", ["default", "sharded", "legacy"])
+def test_prune(tmp_path, backend, history):
+    shard_size = 1 if history == "sharded" else 0
+    if backend == "lmdb":
+        db = VersionDB.open_lmdb(tmp_path, history_shard_size=shard_size)
+    else:
+        db = VersionDB.open_rocksdb(tmp_path, history_shard_size=shard_size)
+    init_test_db(db)
+    if history == "legacy":
+        # written before the creations are recorded, the history is scanned
+        with db.write_batches() as batches:
+            batches.plain.delete(CHANGESET_CREATIONS_KEY)
+        db = VersionDB(db.plain, db.changeset, db.history)
+    expected = {
+        v: list(db.iterator(v, "evm")) for v in range(2, db.latest_version() + 1)
+    }
+    changes = list(db.changes(3))
+
+    assert db.prune(2, batch_size=2) > 0
+    assert 2 == db.pruned_version()
+    with pytest.raises(VersionPrunedError):
+        db.get(1, "evm", b"delete-in-block2")
+    with pytest.raises(VersionPrunedError):
+        db.iterator(1, "evm")
+    for v, items in expected.items():
+        assert items == list(db.iterator(v, "evm")), f"block-{v}"
+    assert b"1" == db.get(2, "evm", b"add-in-block2")
+    # the changes of the pruned version itself are deleted
+    with pytest.raises(VersionPrunedError):
+        db.changes(2, 2)
+    with pytest.raises(VersionPrunedError):
+        db.key_history("evm", b"modify-in-block2", 2)
+    assert [] == list(db.key_history("evm", b"modify-in-block2"))
+    assert [KeyChange(3, None, b"2"), KeyChange(4, b"2", None)] == list(
+        db.key_history("evm", b"re-add-in-block3")
+    )
+    assert changes == list(db.changes(3))
+    assert 0 == db.prune(2)
+
+    # continues after the last prune, and trims the shards as well
+    assert db.prune(4, batch_size=2) > 0
+    assert expected[4] == list(db.iterator(4, "evm"))
+    for store in (db.changeset, db.history):
+        it = store.iteritems()
+        it.seek_to_first()
+        assert [] == list(it)
+
+
+def test_changes(testdb):
+    changes = list(testdb.changes(2, 3))
+    assert [
+        Change(2, "evm", b"add-in-block2", None, b"1"),
+        Change(2, "evm", b"delete-in-block2", b"1", None),
+        Change(2, "evm", b"modify-in-block2", b"1", b"2"),
+        Change(2, "staking", b"key1", None, b"value2"),
+        Change(3, "evm", b"re-add-in-block3", None, b"2"),
+    ] == changes
+    assert [c for c in changes if c.store_key == "staking"] == list(
+        testdb.changes(2, 3, store_key="staking")
+    )
+    # genesis state is not recorded in changeset
+    assert [
+        Change(1, "evm", b"add-in-block1", None, b"1"),
+        Change(1, "evm", b"re-add-in-block3", b"1", None),
+        Change(1, "staking", b"key1", b"value1", None),
+    ] == list(testdb.changes(0, 1))
+    assert [Change(4, "evm", b"re-add-in-block3", b"2", None)] == list(
+        testdb.changes(4)
+    )
+    assert [] == list(testdb.changes(4, 3))
+
+
+def test_key_history(testdb):
+    expected = [
+        KeyChange(1, b"1", None),
+        KeyChange(3, None, b"2"),
+        KeyChange(4, b"2", None),
+    ]
+    assert expected == list(testdb.key_history("evm", b"re-add-in-block3"))
+    assert expected == list(
+        testdb.key_history("evm", b"re-add-in-block3", batch_size=1)
+    )
+    assert expected[1:2] == list(
+        testdb.key_history("evm", b"re-add-in-block3", 2, 3, batch_size=1)
+    )
+    assert [KeyChange(2, b"1", b"2")] == list(
+        testdb.key_history("evm", b"modify-in-block2")
+    )
+    assert [] == list(testdb.key_history("evm", b"z-genesis-only"))
+    assert [] == list(testdb.key_history("evm", b"not-exist"))
+
+
+def test_metrics(tmp_path):
+    events = []
+    metrics = Metrics(sink=lambda name, value: events.append(name))
+    db = VersionDB.open_lmdb(tmp_path, metrics=metrics)
+    init_test_db(db)
+    assert 5 == metrics.counters["put_blocks"]
+    assert 5 == metrics.histograms["put_seconds"].count
+
+    db.get(0, "evm", b"delete-in-block2")
+    db.get(None, "evm", b"delete-in-block2")
+    db.multi_get(2, "evm", [b"re-add-in-block3", b"add-in-block2"])
+    assert 4 == metrics.counters["get_total"]
+    assert 2 == metrics.counters["get_changeset_hits"]
+    assert 2 == metrics.counters["get_plain_fallbacks"]
+
+    list(db.iterator(2, "evm"))
+    assert metrics.counters["iter_bitmaps_deserialized"] > 0
+    assert metrics.counters["iter_deleted_skipped"] > 0
+    assert "get_seconds" in events
+
+    text = metrics.to_prometheus()
+    assert "versiondb_get_total 4\n" in text
+    assert 'versiondb_put_seconds_bucket{le="+Inf"} 5\n' in text
+    assert db.store_properties()["plain"]["entries"] > 0
+
+
+@pytest.mark.parametrize("layout", ["separate", "cf"])
+def test_open_modes(tmp_path, layout):
+    db = VersionDB.open_rocksdb(tmp_path / "db", layout=layout)
+    init_test_db(db)
+
+    # don't conflict with the writer
+    readonly = VersionDB.open_rocksdb(tmp_path / "db", mode="readonly")
+    secondary = VersionDB.open_rocksdb(
+        tmp_path / "db",
+        mode="secondary",
+        secondary_path=tmp_path / "secondary",
+        cache_size=100,
+    )
+    assert 4 == readonly.latest_version() == secondary.latest_version()
+    assert b"2" == secondary.get(None, "evm", b"modify-in-block2")
+
+    db.put(5, [KVPair("evm", b"modify-in-block2", b"5")])
+    assert 4 == secondary.latest_version()
+    secondary.catch_up()
+    assert 5 == secondary.latest_version()
+    assert b"5" == secondary.get(None, "evm", b"modify-in-block2")
+    assert b"2" == secondary.get(4, "evm", b"modify-in-block2")
+    assert 4 == readonly.latest_version()
+
+    # the prune of the writer is followed
+    assert db.prune(3) > 0
+    assert b"1" == secondary.get(1, "evm", b"delete-in-block2")
+    secondary.catch_up()
+    assert 3 == secondary.pruned_version()
+    with pytest.raises(VersionPrunedError):
+        secondary.get(1, "evm", b"delete-in-block2")
+    assert b"2" == secondary.get(4, "evm", b"modify-in-block2")
+
+
+def test_catch_up_cache(tmp_path):
+    db = VersionDB.open_lmdb(tmp_path, cache_size=100)
+    init_test_db(db)
+    assert 4 == db.latest_version()
+    assert db.get_bitmap(full_key("evm", b"modify-in-block2")) is not None
+    db.catch_up()
+    assert 0 == len(db.bitmap_cache)
+    assert 4 == db.latest_version()
+
+    # a reader of the same environment follows the prune on catch up
+    reader = VersionDB(db.plain, db.changeset, db.history)
+    db.prune(3)
+    assert 0 == reader.pruned_version()
+    reader.catch_up()
+    assert 3 == reader.pruned_version()
+    with pytest.raises(VersionPrunedError):
+        reader.get(1, "evm", b"delete-in-block2")
+
+
+def test_compact_key_codec(tmp_path):
+    text = VersionDB.open_lmdb(tmp_path / "text")
+    compact = VersionDB.open_lmdb(tmp_path / "compact", key_codec="compact")
+    init_test_db(text)
+    init_test_db(compact)
+    assert [] == list(compare_dbs(text, compact, ["evm", "staking", "unknown"]))
+    assert list(text.changes(0)) == list(compact.changes(0))
+
+    # the codec and store ids are loaded on reopen
+    reopened = VersionDB(compact.plain, compact.changeset, compact.history)
+    assert "compact" == reopened.codec.name
+    assert {"evm": 0, "staking": 1} == reopened.codec.ids
+    with pytest.raises(AssertionError):
+        VersionDB(compact.plain, compact.changeset, compact.history, key_codec="text")
+
+    # the id registered in a failed write is allocated again
+    db = VersionDB.open_lmdb(tmp_path / "failed", key_codec="compact")
+    with pytest.raises(AssertionError):
+        db.put(0, [KVPair("bank", b"k", b"1"), KVPair("bank", b"bad", None)])
+    db.put(0, [KVPair("bank", b"k", b"1")])
+    reopened = VersionDB(db.plain, db.changeset, db.history)
+    assert {"bank": 0} == reopened.codec.ids
+    assert b"1" == reopened.get(None, "bank", b"k")
+
+    dst = VersionDB.open_lmdb(tmp_path / "reencoded", key_codec="compact")
+    stats = reencode_keys(text, dst, batch_size=3)
+    assert stats["plain"]["dst_key_bytes"] < stats["plain"]["src_key_bytes"]
+    assert [] == list(compare_dbs(text, dst, ["evm", "staking"]))
+
+    # the codec is recorded before the copied keys
+    dst = VersionDB.open_lmdb(tmp_path / "interrupted", key_codec="compact")
+
+    def fail(*args):
+        raise IOError("interrupted")
+
+    dst.write_key = fail
+    with pytest.raises(IOError):
+        reencode_keys(text, dst, batch_size=3)
+    assert "compact" == VersionDB(dst.plain, dst.changeset, dst.history).codec.name
+
+
+@pytest.mark.parametrize("backend", ["rocksdb", "lmdb"])
+@pytest.mark.parametrize("key_codec", ["text", "compact"])
+def test_bulk_load(tmp_path, backend, key_codec):
+    def open_db(name):
+        if backend == "lmdb":
+            return VersionDB.open_lmdb(tmp_path / name, key_codec=key_codec)
+        return VersionDB.open_rocksdb(tmp_path / name, key_codec=key_codec)
+
+    # unordered, across the runs, with duplicated keys
+    pairs = [
+        KVPair(store, b"key%03d" % (i * 37 % 100), b"%d" % i)
+        for i in range(100)
+        for store in ("staking", "evm")
+    ] + [KVPair("evm", b"key000", b"last")]
+    expected = open_db("expected")
+    expected.put(0, pairs)
+    db = open_db("bulk")
+    assert 200 == db.bulk_load(pairs, run_size=7, tmp_dir=tmp_path)
+    assert 0 == db.latest_version()
+    assert b"last" == db.get(0, "evm", b"key000")
+    assert [] == list(compare_dbs(expected, db, ["evm", "staking"]))
+    with pytest.raises(AssertionError):
+        db.bulk_load(pairs)
+
+    for v in (1, 2):
+        change_set = [KVPair("evm", b"key%03d" % v, None)]
+        expected.put(v, change_set)
+        db.put(v, change_set)
+    assert [] == list(compare_dbs(expected, db, ["evm", "staking"]))
+
+    empty = open_db("empty")
+    assert 0 == empty.bulk_load([])
+    assert 0 == empty.latest_version()
+
+
+@pytest.mark.parametrize("backend", ["rocksdb", "rocksdb-cf", "lmdb"])
+def test_checkpoint(tmp_path, backend):
+    if backend == "lmdb":
+        db = VersionDB.open_lmdb(tmp_path / "db")
+    else:
+        layout = "cf" if backend == "rocksdb-cf" else "separate"
+        db = VersionDB.open_rocksdb(tmp_path / "db", layout=layout)
+    init_test_db(db)
+    manifest = db.checkpoint(tmp_path / "checkpoint")
+    assert 4 == manifest["version"]
+    assert (tmp_path / "checkpoint" / CHECKPOINT_MANIFEST).exists()
+    with pytest.raises(FileExistsError):
+        db.checkpoint(tmp_path / "checkpoint")
+
+    if backend == "lmdb":
+        copy = VersionDB.open_lmdb(tmp_path / "checkpoint")
+    else:
+        copy = VersionDB.open_rocksdb(tmp_path / "checkpoint")
+    assert [] == list(compare_dbs(db, copy, ["evm", "staking"]))
+
+    # not affected by the later writes
+    db.put(5, [KVPair("evm", b"after-checkpoint", b"1")])
+    assert 4 == copy.latest_version()
+    assert copy.get(None, "evm", b"after-checkpoint") is None
+
+
+def test_history_header(testdb):
+    def query_all(db):
+        return [
+            (
+                db.multi_get(v, "evm", keys),
+                [db.get(v, "evm", k) for k in keys],
+                list(db.iterator(v, "evm")),
+            )
+            for v in range(5)
+        ]
+
+    keys = store_keys(testdb, "evm")
+    expected = query_all(testdb)
+
+    # downgrade to the old format
+    it = testdb.history.iteritems()
+    it.seek_to_first()
+    values = list(it)
+    assert all(history_bounds(v) is not None for _, v in values)
+    with testdb.write_batches() as batches:
+        for k, v in values:
+            batches.history.put(k, decode_history(v).serialize())
+    assert expected == query_all(testdb)
+
+    assert len(values) == testdb.upgrade_history(batch_size=2)
+    assert 0 == testdb.upgrade_history()
+    assert expected == query_all(testdb)
+
+
+def test_iterator_bounds(testdb):
+    for version in range(5):
+        items = list(testdb.iterator(version, "evm"))
+        keys = [k for k, _ in items]
+        for start, end in [
+            (None, b"modify-in-block2"),
+            (b"delete-in-block2", b"re-add-in-block3"),
+            (b"b", b"c"),
+            (b"modify-in-block2", None),
+        ]:
+            expected = [
+                (k, v)
+                for k, v in items
+                if (start is None or k >= start) and (end is None or k < end)
+            ]
+            assert expected == list(
+                testdb.iterator(version, "evm", start, end=end)
+            ), f"block-{version}"
+            assert expected[:1] == list(
+                testdb.iterator(version, "evm", start, end=end, limit=1)
+            )
+            # end is exclusive in the iteration order
+            expected = [
+                (k, v)
+                for k, v in reversed(items)
+                if (start is None or k <= start) and (end is None or k > end)
+            ]
+            assert expected == list(
+                testdb.iterator(version, "evm", start, end=end, reverse=True)
+            ), f"block-{version}"
+
+        prefix = testdb.codec.prefix("evm")
+        assert [prefix + k for k in keys] == [
+            k for k, _ in testdb.iterator(version, "evm", raw_keys=True)
+        ]
@@ -1,3 +1,3 @@
 __version__ = "0.1.0"
 
-from .versiondb import KVPair, VersionDB
+from .versiondb import Change, KeyChange, KVPair, VersionDB, VersionPrunedError
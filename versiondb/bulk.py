@@ -0,0 +1,140 @@
+"""
+bulk load the genesis state into a fresh db, bypassing the memtable and the WAL.
+
+the pairs are sorted in runs of bounded size, all but the last run are spilled
+into temporary files, then the runs are merged into non-overlapping sst files
+which are ingested in one call, so the load is atomic.
+
+lmdb has no external files, the merged pairs are appended to the b-tree in
+ordered transactions instead. so are the rocksdb bindings built without
+SstFileWriter, the merged pairs are written in ordered write batches.
+"""
+
+import heapq
+import mmap
+import os
+from operator import itemgetter
+from pathlib import Path
+from typing import Iterable, Iterator, List, Tuple
+
+import rocksdb
+from cprotobuf import decode_primitive, encode_primitive
+
+# pairs per sorted run, bounds the memory usage of the sort
+DEFAULT_RUN_SIZE = 1000000
+# the target size of the sst files, before compression
+DEFAULT_SST_SIZE = 256 * 1024 * 1024
+# pairs per write batch, if the binding can't write sst files
+DEFAULT_BATCH_SIZE = 10000
+
+HAS_SST_WRITER = hasattr(rocksdb, "SstFileWriter")
+
+Pair = Tuple[bytes, bytes]
+
+
+def sorted_runs(pairs: Iterable[Pair], run_size: int) -> Iterator[List[Pair]]:
+    "the sort is stable, so the duplicated keys keep the input order"
+    run = []
+    for pair in pairs:
+        run.append(pair)
+        if len(run) >= run_size:
+            run.sort(key=itemgetter(0))
+            yield run
+            run = []
+    if run:
+        run.sort(key=itemgetter(0))
+        yield run
+
+
+def write_run(path, run: List[Pair]):
+    "length prefixed keys and values"
+    with open(path, "wb") as fp:
+        for key, value in run:
+            fp.write(encode_primitive("uint64", len(key)))
+            fp.write(key)
+            fp.write(encode_primitive("uint64", len(value)))
+            fp.write(value)
+
+
+def read_run(path) -> Iterator[Pair]:
+    "the reverse of write_run"
+    with open(path, "rb") as fp:
+        if os.fstat(fp.fileno()).st_size == 0:
+            return
+        with mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            offset = 0
+            while offset < len(mm):
+                size, n = decode_primitive(mm[offset : offset + 10], "uint64")
+                offset += n
+                key = mm[offset : offset + size]
+                offset += size
+                size, n = decode_primitive(mm[offset : offset + 10], "uint64")
+                offset += n
+                value = mm[offset : offset + size]
+                offset += size
+                yield key, value
+
+
+def dedup_sorted(pairs: Iterable[Pair]) -> Iterator[Pair]:
+    "the last one of the duplicated keys wins, like the writes in a batch"
+    prev = None
+    for pair in pairs:
+        if prev is not None and prev[0] != pair[0]:
+            yield prev
+        prev = pair
+    if prev is not None:
+        yield prev
+
+
+def sort_pairs(pairs: Iterable[Pair], run_size: int, tmp_dir) -> Iterator[Pair]:
+    """
+    external merge sort, the input is consumed eagerly, the merged output is
+    lazy and reads the spilled runs from `tmp_dir`.
+    """
+    files = []
+    last = None
+    for run in sorted_runs(pairs, run_size):
+        if last is not None:
+            path = Path(tmp_dir) / f"run-{len(files):06d}"
+            write_run(path, last)
+            files.append(path)
+        last = run
+    if last is None:
+        return iter(())
+    # heapq.merge is stable on the order of the runs, the last run is the newest.
+    runs = [read_run(path) for path in files] + [iter(last)]
+    return dedup_sorted(heapq.merge(*runs, key=itemgetter(0)))
+
+
+def write_sst_files(
+    pairs: Iterable[Pair],
+    tmp_dir,
+    opts=None,
+    target_size: int = DEFAULT_SST_SIZE,
+) -> Tuple[List[str], int]:
+    """
+    write the sorted pairs into sst files of about `target_size` bytes,
+    return the files and the number of pairs written.
+    """
+    if opts is None:
+        opts = rocksdb.Options()
+    files = []
+    count = 0
+    writer = None
+    size = 0
+    for key, value in pairs:
+        if writer is None:
+            path = str(Path(tmp_dir) / f"bulk-{len(files):06d}.sst")
+            writer = rocksdb.SstFileWriter(opts)
+            writer.open(path)
+            files.append(path)
+            size = 0
+        writer.put(key, value)
+        count += 1
+        size += len(key) + len(value)
+        if size >= target_size:
+            writer.finish()
+            writer = None
+    if writer is not None:
+        writer.finish()
+    return files, count
@@ -0,0 +1,63 @@
+import threading
+from collections import OrderedDict
+
+# distinguish a cache miss from a cached None
+MISSING = object()
+
+
+class LRUCache:
+    """
+    bounded cache with least-recently-used eviction,
+    count the hits and misses to help sizing the cache.
+
+    thread-safe, so it can be shared by the query threads.
+    """
+
+    capacity: int
+    hits: int
+    misses: int
+
+    def __init__(self, capacity: int):
+        assert capacity > 0, "capacity must be positive"
+        self.capacity = capacity
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key):
+        with self._lock:
+            try:
+                value = self._data[key]
+            except KeyError:
+                self.misses += 1
+                return MISSING
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            if len(self._data) > self.capacity:
+                self._data.popitem(last=False)
+
+    def pop(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self) -> dict:
+        return {
+            "capacity": self.capacity,
+            "size": len(self._data),
+            "hits": self.hits,
+            "misses": self.misses,
+        }
@@ -1,6 +1,10 @@
 import binascii
+import builtins
 import itertools
+import json
+import time
 from pathlib import Path
+from typing import Optional
 
 import click
 
@@ -12,6 +16,10 @@ def encode_bytes(v: bytes):
         return "0x" + binascii.hexlify(v).decode()
 
 
+def encode_optional_bytes(v: Optional[bytes]):
+    return encode_bytes(v) if v is not None else None
+
+
 def decode_bytes(v: str):
     if v.startswith("0x"):
         return binascii.unhexlify(v[2:])
@@ -19,6 +27,44 @@ def decode_bytes(v: str):
         return v.encode()
 
 
+def tuning_options(f):
+    "options to select and override the rocksdb tuning profile"
+    f = click.option(
+        "--tuning",
+        type=click.Path(exists=True),
+        help="json file to override the settings of the profile",
+    )(f)
+    f = click.option(
+        "--profile",
+        type=click.Choice(["default", "ingest", "query", "archive"]),
+        default=None,
+        help="rocksdb tuning profile",
+    )(f)
+    return f
+
+
+def mode_option(f):
+    "readers don't take the lock by default, so they can run next to the writer"
+    return click.option(
+        "--mode",
+        type=click.Choice(["readonly", "secondary", "readwrite"]),
+        default="readonly",
+        help="how to open the rocksdb databases",
+    )(f)
+
+
+def open_versiondb(db, profile=None, tuning=None, **kwargs):
+    from .options import load_config
+    from .versiondb import VersionDB
+
+    return VersionDB.open_rocksdb(
+        Path(db),
+        profile=profile,
+        tuning=load_config(tuning) if tuning else None,
+        **kwargs,
+    )
+
+
 @click.group
 def cli():
     pass
@@ -26,24 +72,152 @@ def cli():
 
 @cli.command()
 @click.option("--db", help="path to versiondb", type=click.Path(exists=True))
+@click.option(
+    "--workers",
+    default=0,
+    help="number of processes to decode block files ahead of the writer",
+)
+@click.option(
+    "--prefetch",
+    default=None,
+    type=click.INT,
+    help="max number of blocks in flight, default to twice the workers",
+)
+@click.option(
+    "--layout",
+    type=click.Choice(["separate", "cf"]),
+    default=None,
+    help="layout of a new db, detected from the files of an existing one",
+)
+@click.option(
+    "--merge-history",
+    is_flag=True,
+    help="append to history bitmaps with the rocksdb merge operator",
+)
+@click.option(
+    "--history-shard-size",
+    default=0,
+    help="split the history bitmaps into shards of this many versions",
+)
+@click.option(
+    "--follow",
+    is_flag=True,
+    help="keep waiting for the new blocks, until interrupted",
+)
+@click.option("--poll-interval", default=1.0, help="seconds between polls in follow")
+@click.option(
+    "--keep-versions",
+    default=None,
+    type=click.INT,
+    help="in follow, prune the versions older than the latest n in the background",
+)
+@click.option("--prune-interval", default=60.0, help="seconds between the prunes")
+@click.option(
+    "--upgrade-history",
+    is_flag=True,
+    help="in follow, add the header to the old history values in the background",
+)
+@click.option(
+    "--metrics-file",
+    default=None,
+    type=click.Path(),
+    help="in follow, write the metrics and sync lag to it in prometheus text format",
+)
+@click.option(
+    "--checkpoint-dir",
+    default=None,
+    type=click.Path(),
+    help="in follow, create a checkpoint under it on SIGUSR1",
+)
+@tuning_options
 @click.argument("file-streamer", type=click.Path(exists=True))
-def sync_local(db, file_streamer):
-    from .sync import sync_local
-    from .versiondb import VersionDB
+def sync_local(
+    db,
+    file_streamer,
+    workers,
+    prefetch,
+    layout,
+    merge_history,
+    history_shard_size,
+    follow,
+    poll_interval,
+    keep_versions,
+    prune_interval,
+    upgrade_history,
+    metrics_file,
+    checkpoint_dir,
+    profile,
+    tuning,
+):
+    from .metrics import Metrics
+    from .sync import follow as follow_blocks
+    from .sync import prune_loop, sync_local
 
-    sync_local(Path(file_streamer), VersionDB.open_rocksdb(Path(db)))
+    versiondb = open_versiondb(
+        db,
+        profile,
+        tuning,
+        layout=layout,
+        merge_history=merge_history,
+        history_shard_size=history_shard_size,
+        metrics=Metrics() if metrics_file else None,
+    )
+    begin = time.monotonic()
+    if follow:
+        import signal
+        import threading
+
+        # finish the current block, then exit
+        stop = threading.Event()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(sig, lambda *_: stop.set())
+        if checkpoint_dir is not None:
+            # the handler runs in the writer thread, which could hold the write
+            # lock, so the checkpoint waits for it in another thread.
+            def start_checkpoint(*_):
+                dest = Path(checkpoint_dir) / time.strftime("%Y%m%d-%H%M%S")
+                threading.Thread(
+                    target=create_checkpoint, args=(versiondb, dest), daemon=True
+                ).start()
+
+            signal.signal(signal.SIGUSR1, start_checkpoint)
+        if keep_versions is not None:
+            threading.Thread(
+                target=prune_loop,
+                args=(versiondb, keep_versions, prune_interval, stop),
+                daemon=True,
+            ).start()
+        if upgrade_history:
+            # one pass, the new values are written with the header anyway
+            threading.Thread(target=versiondb.upgrade_history, daemon=True).start()
+        count = follow_blocks(
+            Path(file_streamer),
+            versiondb,
+            workers=workers,
+            prefetch=prefetch,
+            poll_interval=poll_interval,
+            stop=stop,
+            metrics_file=metrics_file,
+        )
+    else:
+        count = sync_local(
+            Path(file_streamer), versiondb, workers=workers, prefetch=prefetch
+        )
+    elapsed = time.monotonic() - begin
+    rate = count / elapsed if elapsed > 0 else 0
+    print(f"synced {count} blocks in {elapsed:.2f}s, {rate:.2f} blocks/s")
 
 
 @cli.command()
 @click.option("--db", help="path to versiondb", type=click.Path(exists=True))
 @click.option("--version", default=None, type=click.INT)
+@mode_option
+@tuning_options
 @click.argument("store_key", type=click.STRING)
 @click.argument("key", type=click.STRING)
-def get(db, store_key, key, version):
-    from .versiondb import VersionDB
-
+def get(db, store_key, key, version, mode, profile, tuning):
     key = decode_bytes(key)
-    versiondb = VersionDB.open_rocksdb(Path(db))
+    versiondb = open_versiondb(db, profile, tuning, mode=mode)
     value = versiondb.get(version, store_key, key)
     if value:
         print(encode_bytes(value))
@@ -52,21 +226,406 @@ def get(db, store_key, key, version):
 @cli.command()
 @click.option("--db", help="path to versiondb", type=click.Path(exists=True))
 @click.option("--version", default=None, type=click.INT)
-@click.option("--start", type=click.STRING)
+@mode_option
+@tuning_options
+@click.argument("store_key", type=click.STRING, required=False)
+def multi_get(db, store_key, version, mode, profile, tuning):
+    """
+    read keys from stdin, one per line, print the found ones as "key value"
+    in input order, each line is "store_key key" if STORE_KEY is not given.
+    """
+    pairs = []
+    for line in click.get_text_stream("stdin"):
+        line = line.strip()
+        if not line:
+            continue
+        if store_key:
+            pairs.append((store_key, decode_bytes(line)))
+        else:
+            sk, key = line.split(" ", 1)
+            pairs.append((sk, decode_bytes(key)))
+
+    versiondb = open_versiondb(db, profile, tuning, mode=mode)
+    for (_, key), value in zip(pairs, versiondb.multi_get_stores(version, pairs)):
+        if value is not None:
+            print(encode_bytes(key), encode_bytes(value))
+
+
+@cli.command()
+@click.option("--db", help="path to versiondb", type=click.Path(exists=True))
+@click.option("--version", default=None, type=click.INT)
+@click.option("--start", type=click.STRING, help="inclusive")
+@click.option("--end", type=click.STRING, help="exclusive, in the iteration order")
 @click.option("--limit", default=100)
 @click.option("--reverse", default=False)
+@mode_option
+@tuning_options
 @click.argument("store_key", type=click.STRING)
-def range(db, version, store_key, start, reverse, limit):
-    from .versiondb import VersionDB
-
+def range(db, version, store_key, start, end, reverse, limit, mode, profile, tuning):
     if start:
         start = decode_bytes(start)
+    if end:
+        end = decode_bytes(end)
 
-    versiondb = VersionDB.open_rocksdb(Path(db))
-    it = versiondb.iterator(version, store_key, start, reverse=reverse)
-    for k, v in itertools.islice(it, limit):
+    versiondb = open_versiondb(db, profile, tuning, mode=mode)
+    it = versiondb.iterator(
+        version, store_key, start, reverse=reverse, end=end, limit=limit
+    )
+    for k, v in it:
         print(encode_bytes(k), encode_bytes(v))
 
 
+@cli.command()
+@click.option("--batch-size", default=10000)
+@click.argument("src", type=click.Path(exists=True))
+@click.argument("dst", type=click.Path())
+def migrate_cf(src, dst, batch_size):
+    """
+    copy a versiondb in separate layout into the column families layout,
+    stop the sync process before running it.
+    """
+    from .migrate import migrate_to_cf
+
+    counts = migrate_to_cf(Path(src), Path(dst), batch_size=batch_size)
+    for name, count in counts.items():
+        print(f"{name}: {count} records")
+
+
+@cli.command()
+@click.option(
+    "--codec",
+    type=click.Choice(["compact", "text"]),
+    default="compact",
+    help="key codec of the target db",
+)
+@click.option("--layout", type=click.Choice(["separate", "cf"]), default=None)
+@click.option("--batch-size", default=10000)
+@click.argument("src", type=click.Path(exists=True))
+@click.argument("dst", type=click.Path())
+def reencode(src, dst, codec, layout, batch_size):
+    """
+    copy a versiondb into a new one with a different key codec, and report the
+    size saved, stop the sync process before running it.
+    """
+    from .migrate import dir_size, reencode_keys
+    from .versiondb import VersionDB, detect_layout
+
+    src_db = VersionDB.open_rocksdb(Path(src), read_only=True)
+    dst_db = VersionDB.open_rocksdb(
+        Path(dst), layout=layout or detect_layout(Path(src)), key_codec=codec
+    )
+    stats = reencode_keys(src_db, dst_db, batch_size=batch_size)
+    for name, item in stats.items():
+        saved = item["src_key_bytes"] - item["dst_key_bytes"]
+        print(
+            f"{name}: {item['records']} records, key bytes "
+            f"{item['src_key_bytes']} -> {item['dst_key_bytes']}, saved {saved}"
+        )
+    del src_db, dst_db
+    print(f"disk usage: {dir_size(src)} -> {dir_size(dst)} bytes, before compaction")
+
+
+@cli.command()
+@click.option("--db", help="path to versiondb", type=click.Path(exists=True))
+@click.option("--batch-size", default=10000)
+@tuning_options
+def upgrade_history(db, batch_size, profile, tuning):
+    """
+    add the header to the history values written by the older versions, so the
+    historical queries can skip deserializing them. the db can't be opened by
+    sync-local meanwhile, use the --upgrade-history of sync-local --follow to
+    upgrade next to the ingestion.
+    """
+    versiondb = open_versiondb(db, profile, tuning)
+    count = versiondb.upgrade_history(batch_size=batch_size)
+    print(f"upgraded {count} history values")
+
+
+@cli.command()
+@click.option("--store", "stores", multiple=True, required=True, help="store key")
+@click.option("--from-version", default=0)
+@click.option("--to-version", default=None, type=click.INT)
+@click.option("--step", default=1, help="check every n-th version")
+@click.argument("db1", type=click.Path(exists=True))
+@click.argument("db2", type=click.Path(exists=True))
+def verify(db1, db2, stores, from_version, to_version, step):
+    """
+    check two dbs return identical results for get and iterator,
+    for example the ones written with and without --merge-history.
+    """
+    from .verify import compare_dbs
+    from .versiondb import VersionDB
+
+    db1 = VersionDB.open_rocksdb(Path(db1), mode="readonly")
+    db2 = VersionDB.open_rocksdb(Path(db2), mode="readonly")
+    if to_version is None:
+        to_version = db1.latest_version() or 0
+    found = False
+    for diff in compare_dbs(
+        db1, db2, stores, versions=builtins.range(from_version, to_version + 1, step)
+    ):
+        found = True
+        print(diff)
+    if found:
+        raise SystemExit(1)
+    print("identical")
+
+
+@cli.command()
+@click.option("--db", help="path to versiondb", type=click.Path(exists=True))
+@click.option("--host", default="127.0.0.1")
+@click.option("--port", default=8765)
+@click.option("--unix", type=click.Path(), help="listen on unix socket instead")
+@click.option("--workers", default=8, help="threads to run the db calls")
+@click.option("--page-size", default=1000, help="default page size of iterator")
+@click.option(
+    "--line-limit",
+    default=64 * 1024 * 1024,
+    help="max bytes of a request line",
+)
+@click.option("--cache-size", default=0, help="history bitmap cache entries")
+@click.option("--metrics", is_flag=True, help="collect the metrics of the queries")
+@click.option(
+    "--refresh-interval",
+    default=0.0,
+    help="open as secondary instance and follow the writer every n seconds",
+)
+@tuning_options
+def serve(
+    db,
+    host,
+    port,
+    unix,
+    workers,
+    page_size,
+    line_limit,
+    cache_size,
+    metrics,
+    refresh_interval,
+    profile,
+    tuning,
+):
+    """
+    serve the queries on a socket, the db is opened read-only, so it can run next
+    to sync-local, it don't see the new blocks unless --refresh-interval is set.
+    """
+    import asyncio
+
+    from .metrics import Metrics
+    from .server import Server
+
+    versiondb = open_versiondb(
+        db,
+        profile,
+        tuning,
+        mode="secondary" if refresh_interval > 0 else "readonly",
+        refresh_interval=refresh_interval,
+        cache_size=cache_size,
+        metrics=Metrics() if metrics else None,
+    )
+    server = Server(
+        versiondb, workers=workers, page_size=page_size, line_limit=line_limit
+    )
+    asyncio.run(server.serve_forever(host, port, unix))
+
+
+@cli.command()
+@click.option("--db", help="path to versiondb", type=click.Path(exists=True))
+@click.option("--before", required=True, type=click.INT, help="prune before version")
+@click.option("--batch-size", default=10000)
+@tuning_options
+def prune(db, before, batch_size, profile, tuning):
+    """
+    delete the history before a version, the queries on the pruned versions fail
+    after, the db can't be opened by sync-local meanwhile, use the
+    --keep-versions of sync-local --follow to prune next to the ingestion.
+    """
+    versiondb = open_versiondb(db, profile, tuning)
+    count = versiondb.prune(before, batch_size=batch_size)
+    print(f"pruned before {before}: {count} records")
+
+
+@cli.command()
+@click.option("--db", help="path to versiondb", type=click.Path(exists=True))
+@click.option("--version", default=None, type=click.INT, help="latest by default")
+@click.option("--store", "stores", multiple=True, required=True, help="store key")
+@click.option("--ranges", default=1, help="split each store into n key ranges")
+@click.option("--workers", default=0, help="processes to scan the ranges")
+@click.option("--chunk-size", default=100000, help="records per chunk file")
+@tuning_options
+@click.argument("out-dir", type=click.Path())
+def export_state(
+    db, out_dir, version, stores, ranges, workers, chunk_size, profile, tuning
+):
+    """
+    export the full state of the stores at a version into chunk files.
+    """
+    import functools
+
+    from .export import export_state
+
+    manifest = export_state(
+        open_versiondb(db, profile, tuning, read_only=True),
+        Path(out_dir),
+        stores,
+        version=version,
+        ranges=ranges,
+        workers=workers,
+        opener=functools.partial(open_versiondb, db, profile, tuning, read_only=True),
+        chunk_size=chunk_size,
+    )
+    for store_key, chunks in manifest["stores"].items():
+        count = sum(chunk["count"] for chunk in chunks)
+        print(f"{store_key}: {count} records in {len(chunks)} chunks")
+
+
+@cli.command()
+@click.option("--db", help="path to versiondb", type=click.Path())
+@tuning_options
+@click.argument("in-dir", type=click.Path(exists=True))
+def import_state(db, in_dir, profile, tuning):
+    """
+    load a state export into a fresh db as the genesis state.
+    """
+    from .export import import_state
+
+    count = import_state(open_versiondb(db, profile, tuning), Path(in_dir), tmp_dir=db)
+    print(f"imported {count} records")
+
+
+@cli.command()
+@click.option("--db", help="path to versiondb", type=click.Path())
+@click.option(
+    "--run-size",
+    default=1000000,
+    help="number of records sorted in memory at a time",
+)
+@tuning_options
+@click.argument("file", type=click.Path(exists=True))
+def bulk_load(db, file, run_size, profile, tuning):
+    """
+    load the genesis state from a block-0 stream file into a fresh db, through
+    sst files ingested into rocksdb directly.
+    """
+    from .options import load_config, resolve_config, store_options
+    from .sync import open_stream_file
+
+    config = resolve_config(profile, load_config(tuning) if tuning else None)
+    versiondb = open_versiondb(db, profile, tuning)
+    begin = time.monotonic()
+    count = versiondb.bulk_load(
+        (item.to_kvpair() for item in open_stream_file(file)),
+        run_size=run_size,
+        tmp_dir=db,
+        sst_options=store_options(config, "plain", None),
+    )
+    elapsed = time.monotonic() - begin
+    print(f"loaded {count} records in {elapsed:.2f}s")
+
+
+@cli.command()
+@click.option("--db", help="path to versiondb", type=click.Path(exists=True))
+@click.option("--from-version", required=True, type=click.INT)
+@click.option("--to-version", default=None, type=click.INT, help="latest by default")
+@click.option("--store", "store_key", default=None, help="filter by store key")
+@tuning_options
+def changes(db, from_version, to_version, store_key, profile, tuning):
+    """
+    print the changes in the version range as json lines, the values are null if
+    the key don't exist.
+    """
+    versiondb = open_versiondb(db, profile, tuning, read_only=True)
+    for change in versiondb.changes(from_version, to_version, store_key):
+        print(
+            json.dumps(
+                {
+                    "version": change.version,
+                    "store_key": change.store_key,
+                    "key": encode_bytes(change.key),
+                    "old_value": encode_optional_bytes(change.old_value),
+                    "new_value": encode_optional_bytes(change.new_value),
+                }
+            )
+        )
+
+
+@cli.command()
+@click.option("--db", help="path to versiondb", type=click.Path(exists=True))
+@click.option("--from-version", default=None, type=click.INT)
+@click.option("--to-version", default=None, type=click.INT, help="latest by default")
+@click.option("--limit", default=100, type=click.INT, help="the page size, 0 for all")
+@mode_option
+@tuning_options
+@click.argument("store_key", type=click.STRING)
+@click.argument("key", type=click.STRING)
+def history(db, store_key, key, from_version, to_version, limit, mode, profile, tuning):
+    """
+    print the changes of a key as json lines, the values are null if the key don't
+    exist, the --from-version of the next page is printed to stderr if there are
+    more.
+    """
+    key = decode_bytes(key)
+    versiondb = open_versiondb(db, profile, tuning, mode=mode)
+    changes = versiondb.key_history(store_key, key, from_version, to_version)
+    if limit > 0:
+        # one more to tell if there's a next page
+        changes = itertools.islice(changes, limit + 1)
+    for i, change in enumerate(changes):
+        if limit > 0 and i == limit:
+            click.echo(f"next page: --from-version {change.version}", err=True)
+            break
+        print(
+            json.dumps(
+                {
+                    "version": change.version,
+                    "old_value": encode_optional_bytes(change.old_value),
+                    "new_value": encode_optional_bytes(change.new_value),
+                }
+            )
+        )
+
+
+def create_checkpoint(versiondb, dest: Path):
+    manifest = versiondb.checkpoint(dest)
+    click.echo(f"checkpoint at version {manifest['version']}: {dest}", err=True)
+
+
+@cli.command()
+@click.option("--db", help="path to versiondb", type=click.Path(exists=True))
+@tuning_options
+@click.argument("dest", type=click.Path())
+def checkpoint(db, dest, profile, tuning):
+    """
+    create a consistent checkpoint of all the stores in DEST, and print the
+    manifest, the db can't be opened by a writer at the same time, use the
+    --checkpoint-dir of sync-local --follow to checkpoint a live one.
+    """
+    versiondb = open_versiondb(db, profile, tuning)
+    print(json.dumps(versiondb.checkpoint(dest), indent=2))
+
+
+@cli.command()
+@click.option("--db", help="path to versiondb", type=click.Path(exists=True))
+@click.option("--rocksdb-stats", is_flag=True, help="dump the rocksdb statistics")
+@tuning_options
+def stats(db, rocksdb_stats, profile, tuning):
+    """
+    print the versions and the properties of the stores as json.
+    """
+    versiondb = open_versiondb(db, profile, tuning, read_only=True)
+    print(
+        json.dumps(
+            {
+                "latest_version": versiondb.latest_version(),
+                "pruned_version": versiondb.pruned_version(),
+                "stores": versiondb.store_properties(),
+            },
+            indent=2,
+        )
+    )
+    if rocksdb_stats:
+        print(versiondb.rocksdb_stats())
+
+
 if __name__ == "__main__":
     cli()
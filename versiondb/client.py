@@ -0,0 +1,122 @@
+"""
+blocking client of the query server, see `server.py` for the protocol.
+"""
+
+import json
+import socket
+from typing import Iterator, List, Optional, Tuple
+
+from .server import DEFAULT_PAGE_SIZE, decode_hex, encode_hex
+
+
+class ServerError(Exception):
+    pass
+
+
+class Client:
+    """
+    address is "host:port" or the path of the unix socket,
+    the requests on one client are sequential.
+    """
+
+    def __init__(self, address: str):
+        if ":" in address and not address.startswith("/"):
+            host, port = address.rsplit(":", 1)
+            self.sock = socket.create_connection((host, int(port)))
+        else:
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.sock.connect(address)
+        self.file = self.sock.makefile("rwb")
+        self.next_id = 0
+
+    def close(self):
+        self.file.close()
+        self.sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def request(self, method: str, **params) -> Iterator[dict]:
+        "send the request and yield the response messages"
+        self.next_id += 1
+        req = {"id": self.next_id, "method": method, "params": params}
+        self.file.write(json.dumps(req).encode() + b"\n")
+        self.file.flush()
+        while True:
+            line = self.file.readline()
+            if not line:
+                raise ConnectionError("connection closed by server")
+            msg = json.loads(line)
+            # null id if the server can't parse the request
+            assert msg["id"] in (req["id"], None), "unexpected response id"
+            if "error" in msg:
+                raise ServerError(msg["error"])
+            yield msg
+            if msg.get("done", True):
+                break
+
+    def call(self, method: str, **params):
+        (msg,) = self.request(method, **params)
+        return msg["result"]
+
+    def latest_version(self) -> Optional[int]:
+        return self.call("latest_version")
+
+    def metrics(self) -> Optional[str]:
+        return self.call("metrics")
+
+    def get(
+        self, version: Optional[int], store_key: str, key: bytes
+    ) -> Optional[bytes]:
+        return decode_hex(
+            self.call("get", version=version, store_key=store_key, key=key.hex())
+        )
+
+    def multi_get(
+        self, version: Optional[int], store_key: str, keys: List[bytes]
+    ) -> List[Optional[bytes]]:
+        values = self.call(
+            "multi_get",
+            version=version,
+            store_key=store_key,
+            keys=[k.hex() for k in keys],
+        )
+        return [decode_hex(v) for v in values]
+
+    def multi_get_stores(
+        self, version: Optional[int], pairs: List[Tuple[str, bytes]]
+    ) -> List[Optional[bytes]]:
+        values = self.call(
+            "multi_get", version=version, pairs=[[sk, k.hex()] for sk, k in pairs]
+        )
+        return [decode_hex(v) for v in values]
+
+    def iterator(
+        self,
+        version: Optional[int],
+        store_key: str,
+        start: Optional[bytes] = None,
+        reverse: bool = False,
+        limit: Optional[int] = None,
+        page_size: int = DEFAULT_PAGE_SIZE,
+        end: Optional[bytes] = None,
+    ) -> Iterator[Tuple[bytes, bytes]]:
+        """
+        the pages are streamed by the server, the generator must be exhausted
+        before sending other requests on the same client.
+        """
+        for msg in self.request(
+            "iterator",
+            version=version,
+            store_key=store_key,
+            start=encode_hex(start),
+            end=encode_hex(end),
+            reverse=reverse,
+            limit=limit,
+            page_size=page_size,
+        ):
+            for k, v in msg["result"]:
+                yield bytes.fromhex(k), bytes.fromhex(v)
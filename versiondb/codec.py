@@ -0,0 +1,171 @@
+"""
+the encodings of the store key prefix of the full keys, which is shared by all
+three stores, the changeset key is the version followed by the full key.
+
+- text: `s/k:<store_key>/`, the default.
+- compact: `\\x01` followed by the varint id of the store, the ids are allocated
+  on first write, and registered in plain under `s/store-id/<store_key>`.
+
+the codec of a db is recorded in plain under `s/key-codec`, and can only be
+changed offline with `reencode`.
+"""
+
+import itertools
+from typing import Dict, Optional, Tuple
+
+from cprotobuf import decode_primitive, encode_primitive
+
+from .utils import split_full_key, store_key_prefix
+
+KEY_CODEC_KEY = b"s/key-codec"
+STORE_ID_PREFIX = b"s/store-id/"
+
+CODEC_TEXT = "text"
+CODEC_COMPACT = "compact"
+
+COMPACT_PREFIX = b"\x01"
+# the prefix of the unregistered stores, nothing is written under it.
+UNKNOWN_PREFIX = b"\x00"
+
+
+class TextCodec:
+    name = CODEC_TEXT
+
+    def prefix(self, store_key: str) -> bytes:
+        return store_key_prefix(store_key)
+
+    def full_key(self, store_key: str, key: bytes) -> bytes:
+        return self.prefix(store_key) + key
+
+    def split(self, key: bytes) -> Tuple[str, bytes]:
+        return split_full_key(key)
+
+    def register(self, store_key: str) -> Optional[Tuple[bytes, bytes]]:
+        "return the registry record to write in plain if it's a new store"
+        return None
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+
+class CompactCodec:
+    name = CODEC_COMPACT
+
+    ids: Dict[str, int]
+    names: Dict[int, str]
+    # registered in the write in progress, published when it's committed
+    pending: Dict[str, int]
+
+    def __init__(self, plain):
+        self.plain = plain
+        self.ids = {}
+        self.names = {}
+        self.pending = {}
+        self._load()
+
+    def _load(self):
+        it = self.plain.iteritems()
+        it.seek(STORE_ID_PREFIX)
+        for k, v in it:
+            if not k.startswith(STORE_ID_PREFIX):
+                break
+            self._add(k[len(STORE_ID_PREFIX) :].decode(), decode_varint(v))
+
+    def _add(self, store_key: str, id: int):
+        self.ids[store_key] = id
+        self.names[id] = store_key
+
+    def _lookup(self, store_key: str) -> Optional[int]:
+        id = self.ids.get(store_key)
+        if id is None:
+            id = self.pending.get(store_key)
+        if id is None:
+            # could be registered by the writer process after loaded
+            v = self.plain.get(STORE_ID_PREFIX + store_key.encode())
+            if v is not None:
+                id = decode_varint(v)
+                self._add(store_key, id)
+        return id
+
+    def prefix(self, store_key: str) -> bytes:
+        id = self._lookup(store_key)
+        if id is None:
+            return UNKNOWN_PREFIX
+        return COMPACT_PREFIX + encode_varint(id)
+
+    def full_key(self, store_key: str, key: bytes) -> bytes:
+        return self.prefix(store_key) + key
+
+    def split(self, key: bytes) -> Tuple[str, bytes]:
+        id, n = decode_primitive(key[1:11], "uint64")
+        if id not in self.names:
+            # registered by the writer process after loaded
+            self._load()
+        return self.names[id], key[1 + n :]
+
+    def register(self, store_key: str) -> Optional[Tuple[bytes, bytes]]:
+        """
+        allocate the id of a new store, called with the write lock held,
+        return the registry record to write in plain.
+
+        the id is pending until the write is committed, so it's allocated again
+        if the write fails.
+        """
+        if self._lookup(store_key) is not None:
+            return None
+        id = max(itertools.chain(self.names, self.pending.values()), default=-1) + 1
+        self.pending[store_key] = id
+        return STORE_ID_PREFIX + store_key.encode(), encode_varint(id)
+
+    def commit(self):
+        "called after the write that registered the pending ids is committed"
+        for store_key, id in self.pending.items():
+            self._add(store_key, id)
+        self.pending.clear()
+
+    def rollback(self):
+        self.pending.clear()
+
+
+def encode_varint(n: int) -> bytes:
+    # encode_primitive returns a bytearray, which the rocksdb binding rejects
+    return bytes(encode_primitive("uint64", n))
+
+
+def decode_varint(v: bytes) -> int:
+    n, _ = decode_primitive(v, "uint64")
+    return n
+
+
+def prefix_length(src) -> int:
+    "the length of the store key prefix, 0 if not a full key"
+    if src.startswith(b"s/k:"):
+        return src.find(b"/", 4) + 1
+    if src[:1] == COMPACT_PREFIX:
+        # terminated by the last byte of the varint id
+        for i in range(1, min(len(src), 11)):
+            if src[i] < 0x80:
+                return i + 1
+    return 0
+
+
+def open_codec(plain, name: Optional[str] = None, fresh: bool = True):
+    """
+    load the codec recorded in the db, `name` selects the codec of a fresh db.
+    """
+    v = plain.get(KEY_CODEC_KEY)
+    recorded = v.decode() if v else None
+    if recorded is None and not fresh:
+        # the text keys are not recorded
+        recorded = CODEC_TEXT
+    assert (
+        name is None or recorded is None or name == recorded
+    ), f"the db is encoded with {recorded} keys, run reencode to change it"
+    name = recorded or name or CODEC_TEXT
+    if name == CODEC_COMPACT:
+        return CompactCodec(plain)
+    assert name == CODEC_TEXT, f"unknown key codec: {name}"
+    return TextCodec()
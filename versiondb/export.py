@@ -0,0 +1,237 @@
+"""
+export the full state of the stores at a version, and import it into a fresh db
+as the genesis state.
+
+each store's keyspace is split into key ranges by sampled split points, the
+ranges are scanned in parallel, and written into ordered chunk files in the same
+format as the file streamer output, the chunks are listed in `manifest.json`
+with the record counts and sha256 checksums:
+
+    {
+        "version": 100,
+        "stores": {
+            "evm": [{"file": "evm-0000-0000", "count": 3, "sha256": "..."}, ...]
+        }
+    }
+
+the manifest is written last, an export without it is incomplete.
+"""
+
+import hashlib
+import itertools
+import json
+import multiprocessing
+import random
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Callable, Iterable, List, Optional
+
+from .sync import StoreKVPairs, encode_stream_file, iter_stream_entries
+from .utils import incr_bytes, open_bounded
+from .versiondb import KVPair, VersionDB
+
+MANIFEST = "manifest.json"
+
+DEFAULT_CHUNK_SIZE = 100000
+
+# the keys sampled for each range
+SAMPLES_PER_RANGE = 32
+
+
+def split_points(
+    db: VersionDB, store_key: str, ranges: int, seed: int = 0
+) -> List[bytes]:
+    """
+    sample the keys ever existed in the store with a bounded number of seeks,
+    and pick the quantiles as the boundaries of the key ranges.
+
+    the probes are uniform between the first and the last keys, each one seeks
+    to the next existing key, so the ranges are balanced when the keys are
+    spread evenly, like the hashed keys. the ranges only decide the parallelism,
+    any split points give the same export.
+    """
+    if ranges <= 1:
+        return []
+    size = ranges * SAMPLES_PER_RANGE
+    rng = random.Random(seed)
+    prefix = db.codec.prefix(store_key)
+    samples = set()
+    for store in (db.plain, db.history):
+        samples.update(probe_keys(store, prefix, size, rng))
+    samples = sorted(samples)
+    if not samples:
+        return []
+    points = [samples[len(samples) * i // ranges] for i in range(1, ranges)]
+    return sorted(set(points) - {b""})
+
+
+def probe_keys(store, prefix: bytes, size: int, rng: random.Random) -> List[bytes]:
+    "seek to `size` random positions under the prefix, return the keys found"
+    it = open_bounded(store, prefix, incr_bytes(prefix))
+    it.seek_to_first()
+    first = next(it, None)
+    if first is None:
+        return []
+    it.seek_to_last()
+    last = next(it)[0]
+    first = first[0]
+
+    # the keys as the big endian integers of the same width
+    width = max(len(first), len(last))
+    lo = int.from_bytes(first.ljust(width, b"\0"), "big")
+    hi = int.from_bytes(last.ljust(width, b"\0"), "big")
+    keys = [first, last]
+    for _ in range(size):
+        # the padding could make it larger than the last key
+        probe = min(rng.randint(lo, hi).to_bytes(width, "big"), last)
+        it.seek(probe)
+        keys.append(next(it)[0])
+    return [k[len(prefix) :] for k in keys]
+
+
+def export_range(
+    db,
+    version: int,
+    store_key: str,
+    start: Optional[bytes],
+    end: Optional[bytes],
+    out_dir,
+    name: str,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+) -> List[dict]:
+    """
+    scan the key range [start, end) at the version, and write the chunk files.
+
+    db is a VersionDB or a callable to open one, so it can run in worker
+    processes.
+
+    return the manifest entries of the chunks.
+    """
+    if not isinstance(db, VersionDB):
+        db = db()
+    # bounded by the engine, don't read past the end of the range
+    it = db.iterator(version, store_key, start, end=end)
+
+    chunks = []
+    for i in itertools.count():
+        items = list(itertools.islice(it, chunk_size))
+        if not items:
+            break
+        data = encode_stream_file(
+            StoreKVPairs.from_kvpair(KVPair(store_key, k, v)) for k, v in items
+        )
+        file = f"{name}-{i:04d}"
+        (Path(out_dir) / file).write_bytes(data)
+        chunks.append(
+            {
+                "file": file,
+                "count": len(items),
+                "sha256": hashlib.sha256(data).hexdigest(),
+            }
+        )
+    return chunks
+
+
+def export_state(
+    db: VersionDB,
+    out_dir,
+    stores: Iterable[str],
+    version: Optional[int] = None,
+    ranges: int = 1,
+    workers: int = 0,
+    opener: Optional[Callable[[], VersionDB]] = None,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+) -> dict:
+    """
+    export the stores at the version, the latest one by default.
+
+    with workers > 0, the ranges are scanned in a process pool, each worker opens
+    the db with `opener`, which must be picklable, e.g.
+    `functools.partial(VersionDB.open_rocksdb, path, read_only=True)`.
+
+    return the manifest.
+    """
+    if version is None:
+        version = db.latest_version()
+    assert version is not None, "empty db"
+    out_dir = Path(out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+
+    tasks = []
+    for store_key in stores:
+        points = split_points(db, store_key, ranges)
+        bounds = [None, *points, None]
+        for i, (start, end) in enumerate(zip(bounds, bounds[1:])):
+            name = f"{store_key}-{i:04d}"
+            tasks.append((store_key, start, end, name))
+
+    if workers <= 0:
+        results = [
+            export_range(db, version, store_key, start, end, out_dir, name, chunk_size)
+            for store_key, start, end, name in tasks
+        ]
+    else:
+        assert opener is not None, "opener is required to run in worker processes"
+        # spawn, the workers open the db by themselves, don't inherit the handles.
+        ctx = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(max_workers=workers, mp_context=ctx) as executor:
+            futs = [
+                executor.submit(
+                    export_range,
+                    opener,
+                    version,
+                    store_key,
+                    start,
+                    end,
+                    out_dir,
+                    name,
+                    chunk_size,
+                )
+                for store_key, start, end, name in tasks
+            ]
+            results = [fut.result() for fut in futs]
+
+    manifest = {"version": version, "stores": {}}
+    for (store_key, *_), chunks in zip(tasks, results):
+        manifest["stores"].setdefault(store_key, []).extend(chunks)
+    (out_dir / MANIFEST).write_text(json.dumps(manifest, indent=2))
+    return manifest
+
+
+def read_chunk(path, chunk: dict) -> List[KVPair]:
+    data = Path(path).read_bytes()
+    if hashlib.sha256(data).hexdigest() != chunk["sha256"]:
+        raise ValueError(f"checksum mismatch: {chunk['file']}")
+    pairs = [item.to_kvpair() for item in iter_stream_entries(data)]
+    if len(pairs) != chunk["count"]:
+        raise ValueError(f"record count mismatch: {chunk['file']}")
+    return pairs
+
+
+def import_state(db: VersionDB, in_dir, **kwargs) -> int:
+    """
+    load an export into a fresh db as the genesis state (version 0) with
+    `bulk_load`, the chunks are verified against the manifest before loaded,
+    nothing is loaded if any of them is invalid.
+
+    kwargs are passed to `bulk_load`.
+
+    return the number of records imported.
+    """
+    assert db.latest_version() is None, "import into a fresh db only"
+    in_dir = Path(in_dir)
+    manifest = json.loads((in_dir / MANIFEST).read_text())
+
+    def pairs():
+        for store_key, chunks in manifest["stores"].items():
+            last = None
+            for chunk in chunks:
+                for pair in read_chunk(in_dir / chunk["file"], chunk):
+                    if pair.store_key != store_key or (
+                        last is not None and pair.key <= last
+                    ):
+                        raise ValueError(f"unordered records: {chunk['file']}")
+                    last = pair.key
+                    yield pair
+
+    return db.bulk_load(pairs(), **kwargs)
@@ -1,76 +1,91 @@
 from __future__ import annotations
 
-from typing import TYPE_CHECKING
+from collections import deque
+from typing import TYPE_CHECKING, Optional
 
-from roaring64 import BitMap64
-
-from .utils import (changeset_key, full_key, incr_bytes, prefix_iteritems,
-                    seek_bitmap, store_key_prefix)
+from .utils import (bounded_iteritems, changeset_key, decode_history,
+                    seek_bitmap, seek_header)
 
 if TYPE_CHECKING:
-    from .versiondb import VersionDB
+    from .versiondb import Snapshot, VersionDB
+
+# the number of merged keys whose historical values are fetched together,
+# grows from the min to the max, so short scans don't over-read.
+MIN_WINDOW = 16
+MAX_WINDOW = 1024
 
 
 class VersionDBIter:
     store: VersionDB
     version: int
-    start: bytes
+    start: Optional[bytes]
+    end: Optional[bytes]
     reverse: bool
+    # the length of the prefix stripped from the output keys
+    strip: int
 
     # rocksdb.BaseIterator
     iter_plain: object
     iter_history: object
 
     status: int
-    # record the last key values of history cursor
+    # record the last full key values of history cursor
     hk: bytes
     hv: bytes
-    # record the last key values of plain cursor
+    # record the last full key values of plain cursor
     pk: bytes
     pv: bytes
 
+    # read options of the stores
+    plain_opts: dict
+    changeset_opts: dict
+    history_opts: dict
+
+    # resolved items not consumed yet
+    buffer: deque
+    window: int
+    # the bitmaps deserialized in the current window
+    deserialized: int
+
     def __init__(
         self,
         store: VersionDB,
         version: int,
         store_key: str,
-        start: bytes,
+        start: Optional[bytes],
         reverse: bool,
+        snapshot: Optional[Snapshot] = None,
+        end: Optional[bytes] = None,
+        raw_keys: bool = False,
     ):
         self.store = store
         self.version = version
         self.store_key = store_key
         self.start = start
+        self.end = end
         self.reverse = reverse
 
-        iter_plain = store.plain.iteritems()
-        iter_history = store.history.iteritems()
-        if reverse:
-            iter_plain = reversed(iter_plain)
-            iter_history = reversed(iter_history)
-        self.status = 0
-
-        prefix = store_key_prefix(store_key)
-        if start:
-            full_start = prefix + start
-            iter_plain.seek(full_start)
-            iter_history.seek(full_start)
-            if reverse:
-                if iter_plain.get()[0] > full_start:
-                    next(iter_plain)
-                if iter_history.get()[0] > full_start:
-                    next(iter_history)
+        if snapshot is not None:
+            self.plain_opts = {"snapshot": snapshot.plain}
+            self.changeset_opts = {"snapshot": snapshot.changeset}
+            self.history_opts = {"snapshot": snapshot.history}
         else:
-            if not reverse:
-                iter_plain.seek(prefix)
-                iter_history.seek(prefix)
-            else:
-                end = incr_bytes(prefix)
-                iter_plain.seek_for_prev(end)
-                iter_history.seek_for_prev(end)
+            self.plain_opts = self.changeset_opts = self.history_opts = {}
+        self.buffer = deque()
+        self.window = MIN_WINDOW
+        self.deserialized = 0
 
-        self.iter_plain = prefix_iteritems(iter_plain, prefix, reverse)
-        self.iter_history = prefix_iteritems(iter_history, prefix, reverse)
+        self.status = 0
+
+        # the cursors work on the full keys, stripped only in the output
+        prefix = store.codec.prefix(store_key)
+        self.strip = 0 if raw_keys else len(prefix)
+        self.iter_plain = bounded_iteritems(
+            store.plain, prefix, start, end, reverse, **self.plain_opts
+        )
+        self.iter_history = bounded_iteritems(
+            store.history, prefix, start, end, reverse, **self.history_opts
+        )
 
     def __iter__(self):
         return self
@@ -88,41 +103,92 @@ class VersionDBIter:
         self.status = compare_key(self.pk, self.hk, self.reverse)
 
     def __next__(self):
-        while True:
+        while not self.buffer:
+            if not self._fill():
+                raise StopIteration
+        return self.buffer.popleft()
+
+    def _fill(self) -> bool:
+        """
+        merge the next window of keys, and fetch the historical values of them
+        with one multi_get on changeset.
+
+        return False if both cursors have finished.
+        """
+        # (key, value, changeset key), value is resolved from the changeset key
+        # if the later is not None.
+        pending = []
+        # the deleted keys skipped
+        skipped = 0
+        self.deserialized = 0
+        while len(pending) < self.window:
             self._advance()
             if self.status == -2:
-                raise StopIteration
+                break
             elif self.status == 0:
                 # both cursor at same key, try get historical value,
                 # or fallback to latest one.
-                bm = BitMap64.deserialize(self.hv)
-                found = seek_bitmap(bm, self.version)
+                found = self._seek_history()
                 if found is None:
-                    return self.pk, self.pv
-                v = self.store.changeset.get(
-                    changeset_key(found, full_key(self.store_key, self.hk))
-                )
-                if not v:
-                    # deleted, keep advancing
-                    continue
-                return self.hk, v
+                    pending.append((self.pk, self.pv, None))
+                else:
+                    pending.append((self.hk, None, self._changeset_key(found)))
             elif self.status == -1:
                 # the key don't exist in history state, use the plain state value.
-                return self.pk, self.pv
+                pending.append((self.pk, self.pv, None))
             elif self.status == 1:
                 # the key is deleted in plain state, try to use the history state.
-                bm = BitMap64.deserialize(self.hv)
-                found = seek_bitmap(bm, self.version)
+                found = self._seek_history()
                 if found is None:
                     # deleted, keep advancing
+                    skipped += 1
                     continue
-                v = self.store.changeset.get(
-                    changeset_key(found, full_key(self.store_key, self.hk))
-                )
+                pending.append((self.hk, None, self._changeset_key(found)))
+
+        if not pending:
+            self._report(self.deserialized, skipped)
+            return False
+        self.window = min(self.window * 2, MAX_WINDOW)
+
+        keys = [ck for _, _, ck in pending if ck is not None]
+        values = (
+            self.store.changeset.multi_get(keys, **self.changeset_opts) if keys else {}
+        )
+        for k, v, ck in pending:
+            if ck is not None:
+                v = values.get(ck)
                 if not v:
                     # deleted, keep advancing
+                    skipped += 1
                     continue
-                return self.hk, v
+            self.buffer.append((k[self.strip :], v))
+        self._report(self.deserialized, skipped)
+        return True
+
+    def _report(self, seeks: int, skipped: int):
+        "report the counters of a window in one go"
+        metrics = self.store.metrics
+        if metrics is not None:
+            metrics.incr("iter_bitmaps_deserialized", seeks)
+            metrics.incr("iter_deleted_skipped", skipped)
+
+    def _seek_history(self):
+        answered, found = seek_header(self.hv, self.version, self.store._sharded)
+        if answered:
+            return found
+        self.deserialized += 1
+        bm = decode_history(self.hv)
+        if self.store._sharded:
+            return self.store.seek_history(
+                self.hk,
+                bm,
+                self.version,
+                self.history_opts.get("snapshot"),
+            )
+        return seek_bitmap(bm, self.version)
+
+    def _changeset_key(self, version: int) -> bytes:
+        return changeset_key(version, self.hk)
 
 
 def compare_key(k1, k2, reverse: bool):
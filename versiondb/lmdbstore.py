@@ -0,0 +1,211 @@
+"""
+adapt lmdb to the subset of `rocksdb.DB` interface used by `VersionDB`,
+every store is a named sub-database in a shared environment.
+
+the values are returned as bytes copied out of the mmap, not as buffers, they
+outlive the read transactions, in the caches and the decoded results.
+"""
+
+import itertools
+from pathlib import Path
+from typing import Optional
+
+import lmdb
+
+# sparse file, only the pages written take disk space.
+DEFAULT_MAP_SIZE = 1 << 40
+
+
+def open_env(path, map_size: int = DEFAULT_MAP_SIZE, readonly: bool = False):
+    path = Path(path)
+    if not readonly:
+        path.mkdir(parents=True, exist_ok=True)
+    # keep the lock even if readonly, the writer can run in another process.
+    return lmdb.open(str(path), max_dbs=3, map_size=map_size, readonly=readonly)
+
+
+class LMDBStore:
+    env: lmdb.Environment
+    db: object
+
+    def __init__(self, env: lmdb.Environment, name: bytes):
+        self.env = env
+        self.db = env.open_db(name)
+
+    def snapshot(self) -> lmdb.Transaction:
+        "a read transaction can be shared by all the stores in the environment"
+        return self.env.begin()
+
+    def get(self, key: bytes, snapshot=None, **kwargs) -> Optional[bytes]:
+        if snapshot is not None:
+            return snapshot.get(key, db=self.db)
+        with self.env.begin(db=self.db) as txn:
+            return txn.get(key)
+
+    def multi_get(self, keys, snapshot=None, **kwargs) -> dict:
+        if snapshot is not None:
+            return self._multi_get(snapshot, keys)
+        with self.env.begin(db=self.db) as txn:
+            return self._multi_get(txn, keys)
+
+    def _multi_get(self, txn: lmdb.Transaction, keys) -> dict:
+        return {key: txn.get(key, db=self.db) for key in keys}
+
+    def iteritems(
+        self,
+        snapshot=None,
+        iterate_lower_bound: Optional[bytes] = None,
+        iterate_upper_bound: Optional[bytes] = None,
+        **kwargs,
+    ):
+        return LMDBIterator(
+            self.env,
+            self.db,
+            txn=snapshot,
+            lower=iterate_lower_bound,
+            upper=iterate_upper_bound,
+        )
+
+    def append_sorted(self, pairs, batch_size: int = 100000) -> int:
+        """
+        the counterpart of the sst ingestion, append the sorted unique pairs to
+        an empty sub-database, in transactions of `batch_size` pairs.
+
+        return the number of pairs written.
+        """
+        pairs = iter(pairs)
+        count = 0
+        while True:
+            batch = list(itertools.islice(pairs, batch_size))
+            if not batch:
+                return count
+            with self.env.begin(db=self.db, write=True) as txn:
+                _, added = txn.cursor().putmulti(batch, append=True)
+            assert added == len(batch), "the pairs are not sorted or not unique"
+            count += added
+
+    def stat(self) -> dict:
+        "entries and pages of the sub-database"
+        with self.env.begin() as txn:
+            return txn.stat(self.db)
+
+
+class LMDBIterator:
+    """
+    mimic the rocksdb iterator on a lmdb cursor, the read transaction is kept
+    open until the iterator is exhausted, so it reads a consistent snapshot.
+
+    a shared transaction passed in by the caller is not closed by the iterator.
+
+    the keys are bounded to [lower, upper) like the rocksdb read options
+    iterate_lower_bound and iterate_upper_bound.
+    """
+
+    def __init__(
+        self,
+        env: lmdb.Environment,
+        db,
+        reverse: bool = False,
+        txn: Optional[lmdb.Transaction] = None,
+        lower: Optional[bytes] = None,
+        upper: Optional[bytes] = None,
+    ):
+        self.env = env
+        self.db = db
+        self.reverse = reverse
+        self.lower = lower
+        self.upper = upper
+        self.shared_txn = txn
+        self.txn = txn if txn is not None else env.begin()
+        self.cursor = self.txn.cursor(db=db)
+        # rocksdb iterator is positioned at the first item by default
+        if reverse:
+            self.seek_to_last()
+        else:
+            self.seek_to_first()
+
+    def __reversed__(self):
+        self.close()
+        return LMDBIterator(
+            self.env, self.db, not self.reverse, self.shared_txn, self.lower, self.upper
+        )
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if not self.valid:
+            self.close()
+            raise StopIteration
+        item = self.get()
+        if (self.upper is not None and item[0] >= self.upper) or (
+            self.lower is not None and item[0] < self.lower
+        ):
+            self.close()
+            raise StopIteration
+        self.valid = self.cursor.prev() if self.reverse else self.cursor.next()
+        return item
+
+    def get(self):
+        return self.cursor.item()
+
+    def seek(self, key: bytes):
+        self.valid = self.cursor.set_range(key)
+
+    def seek_to_first(self):
+        if self.lower is not None:
+            self.valid = self.cursor.set_range(self.lower)
+        else:
+            self.valid = self.cursor.first()
+
+    def seek_to_last(self):
+        if self.upper is None:
+            self.valid = self.cursor.last()
+        elif self.cursor.set_range(self.upper):
+            # the last key before the exclusive upper bound
+            self.valid = self.cursor.prev()
+        else:
+            self.valid = self.cursor.last()
+
+    def seek_for_prev(self, key: bytes):
+        "position at the last key that is smaller or equal to the key"
+        if self.cursor.set_range(key):
+            if self.cursor.key() == key:
+                self.valid = True
+            else:
+                self.valid = self.cursor.prev()
+        else:
+            self.valid = self.cursor.last()
+
+    def close(self):
+        if self.txn is not None:
+            if self.txn is not self.shared_txn:
+                self.txn.abort()
+            self.txn = None
+        self.valid = False
+
+    def __del__(self):
+        self.close()
+
+
+class TxnStore:
+    """
+    read and write a sub-database inside a write transaction,
+    provide the interface of both the store and the write batch.
+    """
+
+    def __init__(self, txn: lmdb.Transaction, store: LMDBStore):
+        self.txn = txn
+        self.db = store.db
+
+    def get(self, key: bytes) -> Optional[bytes]:
+        return self.txn.get(key, db=self.db)
+
+    def multi_get(self, keys) -> dict:
+        return {key: self.txn.get(key, db=self.db) for key in keys}
+
+    def put(self, key: bytes, value: bytes):
+        self.txn.put(key, value, db=self.db)
+
+    def delete(self, key: bytes):
+        self.txn.delete(key, db=self.db)
@@ -0,0 +1,155 @@
+"""
+opt-in instrumentation of `VersionDB`, pass a `Metrics` to enable it, the hot
+paths only check `metrics is not None` when it's disabled.
+
+counters:
+- get_total, get_changeset_hits, get_plain_fallbacks: point reads, including
+  the ones in multi_get.
+- iter_bitmaps_deserialized, iter_deleted_skipped: historical iterator steps.
+- put_blocks, put_changed_keys: writes.
+- sync_blocks: the blocks synced by `sync-local --follow`.
+
+histograms, in seconds:
+- get_seconds, multi_get_seconds, put_seconds.
+
+gauges:
+- sync_latest_version, sync_lag_blocks: the progress of `sync-local --follow`,
+  written to the file of `--metrics-file`.
+"""
+
+import bisect
+import os
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Callable, Dict, List, Optional
+
+# upper bounds of the latency buckets in seconds, the last one is +Inf
+DEFAULT_BUCKETS = (
+    0.00001,
+    0.00005,
+    0.0001,
+    0.0005,
+    0.001,
+    0.005,
+    0.01,
+    0.05,
+    0.1,
+    0.5,
+    1.0,
+)
+
+# callback of the events: (name, value), value is the increment of a counter,
+# the value of a gauge, or the observation of a histogram.
+Sink = Callable[[str, float], None]
+
+
+class Histogram:
+    buckets: tuple
+    counts: List[int]
+    sum: float
+    count: int
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        # the last one is +Inf
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def to_dict(self) -> dict:
+        return {"buckets": list(self.counts), "sum": self.sum, "count": self.count}
+
+
+class Metrics:
+    """
+    thread-safe counters and latency histograms, the events are forwarded to the
+    sink if given.
+    """
+
+    counters: Dict[str, int]
+    gauges: Dict[str, float]
+    histograms: Dict[str, Histogram]
+    sink: Optional[Sink]
+
+    def __init__(self, sink: Optional[Sink] = None, buckets=DEFAULT_BUCKETS):
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self.sink = sink
+        self.buckets = buckets
+        self._lock = threading.Lock()
+
+    def incr(self, name: str, n: int = 1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+        if self.sink is not None:
+            self.sink(name, n)
+
+    def set(self, name: str, value: float):
+        with self._lock:
+            self.gauges[name] = value
+        if self.sink is not None:
+            self.sink(name, value)
+
+    def observe(self, name: str, value: float):
+        with self._lock:
+            hist = self.histograms.get(name)
+            if hist is None:
+                hist = self.histograms[name] = Histogram(self.buckets)
+            hist.observe(value)
+        if self.sink is not None:
+            self.sink(name, value)
+
+    @contextmanager
+    def timer(self, name: str):
+        begin = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - begin)
+
+    def to_dict(self) -> dict:
+        with self._lock:
+            return {
+                "counters": dict(self.counters),
+                "gauges": dict(self.gauges),
+                "histograms": {k: h.to_dict() for k, h in self.histograms.items()},
+            }
+
+    def to_prometheus(self, namespace: str = "versiondb") -> str:
+        "render in prometheus text exposition format"
+        lines = []
+        with self._lock:
+            for name, value in sorted(self.counters.items()):
+                lines.append(f"# TYPE {namespace}_{name} counter")
+                lines.append(f"{namespace}_{name} {value}")
+            for name, value in sorted(self.gauges.items()):
+                lines.append(f"# TYPE {namespace}_{name} gauge")
+                lines.append(f"{namespace}_{name} {value}")
+            for name, hist in sorted(self.histograms.items()):
+                full = f"{namespace}_{name}"
+                lines.append(f"# TYPE {full} histogram")
+                cumulative = 0
+                for bound, n in zip(hist.buckets + ("+Inf",), hist.counts):
+                    cumulative += n
+                    lines.append(f'{full}_bucket{{le="{bound}"}} {cumulative}')
+                lines.append(f"{full}_sum {hist.sum}")
+                lines.append(f"{full}_count {hist.count}")
+        return "\n".join(lines) + "\n"
+
+    def write_textfile(self, path, namespace: str = "versiondb"):
+        """
+        write the prometheus text to a file atomically, for the textfile
+        collector of node exporter.
+        """
+        path = Path(path)
+        tmp = path.with_name(path.name + ".tmp")
+        tmp.write_text(self.to_prometheus(namespace))
+        os.replace(tmp, path)
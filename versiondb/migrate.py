@@ -0,0 +1,123 @@
+import itertools
+import os
+from pathlib import Path
+
+import rocksdb
+
+from . import rocksdb_cf
+from .codec import CODEC_TEXT, KEY_CODEC_KEY, STORE_ID_PREFIX, prefix_length
+from .utils import SHARD_PREFIX, shard_key
+from .versiondb import CF_DB_NAME, LAYOUT_SEPARATE, MODE_READONLY, VersionDB
+
+
+def migrate_to_cf(src, dst, batch_size: int = 10000) -> dict:
+    """
+    copy a versiondb in separate layout into a new one in column families layout,
+    it's an offline operation, the source db must not be written meanwhile.
+
+    return the number of records copied for each store.
+    """
+    src = VersionDB.open_rocksdb(src, layout=LAYOUT_SEPARATE, mode=MODE_READONLY)
+    dst = Path(dst)
+    dst.mkdir(parents=True, exist_ok=True)
+    db = rocksdb_cf.open_db(dst / CF_DB_NAME)
+
+    counts = {}
+    # plain db is the last one, it contains the latest version.
+    for name in (b"changeset", b"history", b"plain"):
+        handle = db.get_column_family(name)
+        it = getattr(src, name.decode()).iteritems()
+        it.seek_to_first()
+
+        count = 0
+        batch = rocksdb.WriteBatch()
+        for k, v in it:
+            batch.put((handle, k), v)
+            count += 1
+            if count % batch_size == 0:
+                db.write(batch)
+                batch = rocksdb.WriteBatch()
+        db.write(batch)
+        counts[name.decode()] = count
+    return counts
+
+
+def reencode_keys(src: VersionDB, dst: VersionDB, batch_size: int = 10000) -> dict:
+    """
+    copy the records into a fresh db with a different key codec, it's an offline
+    operation, the source db must not be written meanwhile.
+
+    return the number of records and the total key sizes before and after for
+    each store.
+    """
+    assert dst.latest_version() is None, "reencode into a fresh db only"
+    stats = {}
+
+    if dst.codec.name != CODEC_TEXT:
+        # the first write, so the keys copied after are never read with the
+        # default codec, even if the copy is interrupted.
+        with dst.write_batches() as batches:
+            batches.plain.put(KEY_CODEC_KEY, dst.codec.name.encode())
+
+    def translate(key: bytes, batches) -> bytes:
+        store_key, key = src.codec.split(key)
+        return dst.write_key(batches.plain, store_key, key)
+
+    def translate_plain(key: bytes, batches):
+        if prefix_length(key):
+            return translate(key, batches)
+        if key == KEY_CODEC_KEY or key.startswith(STORE_ID_PREFIX):
+            # written by the target codec
+            return None
+        return key
+
+    def translate_changeset(key: bytes, batches):
+        return key[:8] + translate(key[8:], batches)
+
+    def translate_history(key: bytes, batches):
+        if key.startswith(SHARD_PREFIX):
+            n = int.from_bytes(key[len(SHARD_PREFIX) : len(SHARD_PREFIX) + 4], "big")
+            offset = len(SHARD_PREFIX) + 4
+            full = key[offset : offset + n]
+            version = int.from_bytes(key[offset + n :], "big")
+            return shard_key(translate(full, batches), version)
+        return translate(key, batches)
+
+    # plain is the last one, it contains the latest version.
+    for name, fn in (
+        ("changeset", translate_changeset),
+        ("history", translate_history),
+        ("plain", translate_plain),
+    ):
+        it = getattr(src, name).iteritems()
+        it.seek_to_first()
+        count = src_bytes = dst_bytes = 0
+        while True:
+            chunk = list(itertools.islice(it, batch_size))
+            if not chunk:
+                break
+            with dst.write_batches() as batches:
+                batch = getattr(batches, name)
+                for k, v in chunk:
+                    new_key = fn(k, batches)
+                    if new_key is None:
+                        continue
+                    batch.put(new_key, v)
+                    count += 1
+                    src_bytes += len(k)
+                    dst_bytes += len(new_key)
+        stats[name] = {
+            "records": count,
+            "src_key_bytes": src_bytes,
+            "dst_key_bytes": dst_bytes,
+        }
+    return stats
+
+
+def dir_size(path) -> int:
+    "the disk usage of the files under the directory"
+    return sum(
+        os.path.getsize(os.path.join(root, f))
+        for root, _, files in os.walk(path)
+        for f in files
+    )
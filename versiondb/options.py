@@ -0,0 +1,196 @@
+"""
+named rocksdb tuning profiles, a profile is a dict of settings:
+
+- db level: block_cache_size (shared by all the stores), max_open_files
+- store level, in "stores" -> "plain"/"changeset"/"history": bloom_bits,
+  prefix_extractor, compaction_style, compression, write_buffer_size,
+  max_write_buffer_number, target_file_size_base
+
+the settings can be overridden by a json config file, which can also select
+the profile with the "profile" field.
+"""
+
+import copy
+import json
+from pathlib import Path
+from typing import Optional
+
+import rocksdb
+
+from .codec import prefix_length
+from .utils import decode_history, encode_history
+
+STORES = ("plain", "changeset", "history")
+
+DEFAULT_PROFILE = "default"
+
+MiB = 1 << 20
+
+PROFILES = {
+    # bare options, same as before the profiles are introduced.
+    "default": {},
+    # catching up, large memtables to reduce flushes and write stalls.
+    "ingest": {
+        "block_cache_size": 256 * MiB,
+        "stores": {
+            "plain": {
+                "bloom_bits": 10,
+                "compression": "lz4",
+                "write_buffer_size": 128 * MiB,
+                "max_write_buffer_number": 4,
+            },
+            "changeset": {
+                "compression": "lz4",
+                "write_buffer_size": 128 * MiB,
+                "max_write_buffer_number": 4,
+            },
+            "history": {
+                "bloom_bits": 10,
+                "compression": "lz4",
+                "write_buffer_size": 64 * MiB,
+                "max_write_buffer_number": 4,
+            },
+        },
+    },
+    # point lookups and scans on a synced db.
+    "query": {
+        "block_cache_size": 1024 * MiB,
+        "max_open_files": -1,
+        "stores": {
+            "plain": {"bloom_bits": 10, "prefix_extractor": True, "compression": "lz4"},
+            "changeset": {"bloom_bits": 10, "compression": "lz4"},
+            "history": {
+                "bloom_bits": 10,
+                "prefix_extractor": True,
+                "compression": "lz4",
+            },
+        },
+    },
+    # full history, optimize for space.
+    "archive": {
+        "block_cache_size": 128 * MiB,
+        "stores": {
+            "plain": {"bloom_bits": 10, "compression": "zstd"},
+            "changeset": {
+                "bloom_bits": 10,
+                "compression": "zstd",
+                "target_file_size_base": 256 * MiB,
+            },
+            "history": {"bloom_bits": 10, "compression": "zstd"},
+        },
+    },
+}
+
+# the option fields set directly on rocksdb.Options/ColumnFamilyOptions
+CF_FIELDS = (
+    "compaction_style",
+    "write_buffer_size",
+    "max_write_buffer_number",
+    "target_file_size_base",
+)
+
+
+class StoreKeyPrefix(rocksdb.interfaces.SliceTransform):
+    "extract the store key prefix of the keys, `s/k:<store_key>/` or compact one"
+
+    def name(self):
+        return b"versiondb.store_key_prefix"
+
+    def transform(self, src):
+        return (0, prefix_length(src))
+
+    def in_domain(self, src):
+        return prefix_length(src) > 0
+
+    def in_range(self, dst):
+        return self.in_domain(dst) and prefix_length(dst) == len(dst)
+
+
+class BitmapOrOperator(rocksdb.interfaces.AssociativeMergeOperator):
+    "union the serialized history bitmaps"
+
+    def merge(self, key, existing_value, value):
+        if existing_value is None:
+            return (True, value)
+        bm = decode_history(existing_value)
+        for v in decode_history(value):
+            bm.add(v)
+        return (True, encode_history(bm))
+
+    def name(self):
+        return b"versiondb.bitmap_or"
+
+
+def merge_config(base: dict, override: dict) -> dict:
+    "deep merge override into a copy of base"
+    result = copy.deepcopy(base)
+    for k, v in override.items():
+        if isinstance(v, dict) and isinstance(result.get(k), dict):
+            result[k] = merge_config(result[k], v)
+        else:
+            result[k] = copy.deepcopy(v)
+    return result
+
+
+def resolve_config(
+    profile: Optional[str] = None, overrides: Optional[dict] = None
+) -> dict:
+    overrides = overrides or {}
+    profile = overrides.get("profile") or profile or DEFAULT_PROFILE
+    assert profile in PROFILES, f"unknown profile: {profile}"
+    config = merge_config(PROFILES[profile], overrides)
+    config.pop("profile", None)
+    return config
+
+
+def load_config(path) -> dict:
+    return json.loads(Path(path).read_text())
+
+
+def compression_type(name: str):
+    return getattr(rocksdb.CompressionType, f"{name}_compression")
+
+
+def shared_cache(config: dict):
+    size = config.get("block_cache_size")
+    return rocksdb.LRUCache(size) if size else None
+
+
+def apply_store_options(opts, config: dict, store: str, cache):
+    "set the column family level options of a store"
+    cfg = config.get("stores", {}).get(store, {})
+    for field in CF_FIELDS:
+        if field in cfg:
+            setattr(opts, field, cfg[field])
+    if "compression" in cfg:
+        opts.compression = compression_type(cfg["compression"])
+    if cfg.get("prefix_extractor"):
+        opts.prefix_extractor = StoreKeyPrefix()
+    if store == "history":
+        opts.merge_operator = BitmapOrOperator()
+
+    table = {}
+    if cfg.get("bloom_bits"):
+        table["filter_policy"] = rocksdb.BloomFilterPolicy(cfg["bloom_bits"])
+    if cache is not None:
+        table["block_cache"] = cache
+    if table:
+        opts.table_factory = rocksdb.BlockBasedTableFactory(**table)
+    return opts
+
+
+def db_options(config: dict, **kwargs) -> rocksdb.Options:
+    opts = rocksdb.Options(create_if_missing=True, **kwargs)
+    if "max_open_files" in config:
+        opts.max_open_files = config["max_open_files"]
+    return opts
+
+
+def store_options(config: dict, store: str, cache) -> rocksdb.Options:
+    "options of a store in separate layout"
+    return apply_store_options(db_options(config), config, store, cache)
+
+
+def cf_options(config: dict, store: str, cache) -> rocksdb.ColumnFamilyOptions:
+    "options of a store in column families layout"
+    return apply_store_options(rocksdb.ColumnFamilyOptions(), config, store, cache)
@@ -0,0 +1,114 @@
+"""
+single rocksdb instance layout, plain/changeset/history are column families,
+so the whole block is committed with one write batch.
+
+the adapters expose the column families with the same interface as `rocksdb.DB`.
+"""
+
+from pathlib import Path
+
+import rocksdb
+
+COLUMN_FAMILIES = (b"plain", b"changeset", b"history")
+
+
+def open_db(path, opts=None, cf_opts=None, **kwargs) -> rocksdb.DB:
+    if opts is None:
+        opts = rocksdb.Options(
+            create_if_missing=True, create_missing_column_families=True
+        )
+    if cf_opts is None:
+        cf_opts = {}
+    return rocksdb.DB(
+        str(Path(path)),
+        opts,
+        column_families={
+            name: cf_opts.get(name) or rocksdb.ColumnFamilyOptions()
+            for name in COLUMN_FAMILIES
+        },
+        **kwargs,
+    )
+
+
+class ColumnFamily:
+    db: rocksdb.DB
+    handle: object
+
+    def __init__(self, db: rocksdb.DB, name: bytes):
+        self.db = db
+        self.handle = db.get_column_family(name)
+
+    def get(self, key: bytes, *args, **kwargs):
+        return self.db.get((self.handle, key), *args, **kwargs)
+
+    def multi_get(self, keys, *args, **kwargs) -> dict:
+        values = self.db.multi_get(
+            [(self.handle, key) for key in keys], *args, **kwargs
+        )
+        return {key: value for (_, key), value in values.items()}
+
+    def iteritems(self, *args, **kwargs):
+        return CFIterator(self.db.iteritems(self.handle, *args, **kwargs))
+
+    def write(self, batch, *args, **kwargs):
+        "the batch is shared by all the column families"
+        self.db.write(batch, *args, **kwargs)
+
+    def snapshot(self):
+        return self.db.snapshot()
+
+    def ingest_external_file(self, files, **kwargs):
+        self.db.ingest_external_file(files, column_family=self.handle, **kwargs)
+
+    def get_property(self, prop: bytes):
+        return self.db.get_property(prop, self.handle)
+
+
+class CFIterator:
+    "strip the column family handle from the keys"
+
+    def __init__(self, it):
+        self.it = it
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        (_, key), value = next(self.it)
+        return key, value
+
+    def __reversed__(self):
+        return CFIterator(reversed(self.it))
+
+    def get(self):
+        (_, key), value = self.it.get()
+        return key, value
+
+    def seek(self, key: bytes):
+        self.it.seek(key)
+
+    def seek_for_prev(self, key: bytes):
+        self.it.seek_for_prev(key)
+
+    def seek_to_first(self):
+        self.it.seek_to_first()
+
+    def seek_to_last(self):
+        self.it.seek_to_last()
+
+
+class CFBatch:
+    "write into a column family of a shared write batch"
+
+    def __init__(self, batch: rocksdb.WriteBatch, cf: ColumnFamily):
+        self.batch = batch
+        self.handle = cf.handle
+
+    def put(self, key: bytes, value: bytes):
+        self.batch.put((self.handle, key), value)
+
+    def delete(self, key: bytes):
+        self.batch.delete((self.handle, key))
+
+    def merge(self, key: bytes, value: bytes):
+        self.batch.merge((self.handle, key), value)
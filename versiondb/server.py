@@ -0,0 +1,189 @@
+"""
+long-running query server, keep the db and caches warm between the queries.
+
+the protocol is json lines over a tcp or unix socket, every request is one line:
+
+    {"id": 1, "method": "get", "params": {...}}
+
+and it's answered with one response line, keys and values are hex encoded:
+
+    {"id": 1, "result": ...} or {"id": 1, "error": "..."}
+
+except for "iterator", which is answered with a stream of pages, the last one has
+"done": true.
+
+the request lines longer than the line limit are skipped and answered with an
+error whose id is null, the connection is kept.
+
+methods:
+- latest_version: {}
+- get: {"version", "store_key", "key"}
+- multi_get: {"version", "store_key", "keys"}, or {"version", "pairs"} with
+  [store_key, key] pairs across stores.
+- iterator: {"version", "store_key", "start", "end", "reverse", "limit",
+  "page_size"}
+- metrics: {}, the prometheus text if the metrics is enabled.
+"""
+
+import asyncio
+import functools
+import itertools
+import json
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+from .versiondb import VersionDB
+
+DEFAULT_PAGE_SIZE = 1000
+# the max length of a request line, multi_get with many keys could be large.
+DEFAULT_LINE_LIMIT = 64 * 1024 * 1024
+
+
+def encode_hex(v: Optional[bytes]) -> Optional[str]:
+    return v.hex() if v is not None else None
+
+
+def decode_hex(v: Optional[str]) -> Optional[bytes]:
+    return bytes.fromhex(v) if v is not None else None
+
+
+class Server:
+    db: VersionDB
+    executor: ThreadPoolExecutor
+    page_size: int
+    line_limit: int
+
+    def __init__(
+        self,
+        db: VersionDB,
+        workers: int = 8,
+        page_size: int = DEFAULT_PAGE_SIZE,
+        line_limit: int = DEFAULT_LINE_LIMIT,
+    ):
+        self.db = db
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.page_size = page_size
+        self.line_limit = line_limit
+
+    async def call(self, fn, *args, **kwargs):
+        "run the blocking db calls in the thread pool"
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self.executor, functools.partial(fn, *args, **kwargs)
+        )
+
+    async def start(self, host=None, port=None, unix=None):
+        if unix is not None:
+            return await asyncio.start_unix_server(
+                self.handle, path=unix, limit=self.line_limit
+            )
+        return await asyncio.start_server(
+            self.handle, host, port, limit=self.line_limit
+        )
+
+    async def serve_forever(self, host=None, port=None, unix=None):
+        server = await self.start(host, port, unix)
+        async with server:
+            await server.serve_forever()
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                line = await self.read_line(reader)
+                if line is None:
+                    msg = {"id": None, "error": f"line exceeds {self.line_limit} bytes"}
+                    writer.write(json.dumps(msg).encode() + b"\n")
+                    await writer.drain()
+                    continue
+                if not line:
+                    break
+                if not line.strip():
+                    continue
+                req_id = None
+                try:
+                    req = json.loads(line)
+                    req_id = req.get("id")
+                    async for msg in self.dispatch(
+                        req["method"], req.get("params", {})
+                    ):
+                        msg["id"] = req_id
+                        writer.write(json.dumps(msg).encode() + b"\n")
+                        # backpressure on slow clients
+                        await writer.drain()
+                except (ConnectionError, asyncio.CancelledError):
+                    raise
+                except Exception as e:
+                    writer.write(
+                        json.dumps({"id": req_id, "error": repr(e)}).encode() + b"\n"
+                    )
+                    await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def read_line(self, reader: asyncio.StreamReader) -> Optional[bytes]:
+        "return b'' at eof, None if the line is over the limit, it's skipped"
+        try:
+            return await reader.readuntil(b"\n")
+        except asyncio.IncompleteReadError as e:
+            # the last line without separator
+            return e.partial
+        except asyncio.LimitOverrunError as e:
+            consumed = e.consumed
+        try:
+            while True:
+                await reader.readexactly(consumed)
+                try:
+                    await reader.readuntil(b"\n")
+                    return None
+                except asyncio.LimitOverrunError as e:
+                    consumed = e.consumed
+        except asyncio.IncompleteReadError:
+            return b""
+
+    async def dispatch(self, method: str, params: dict):
+        version = params.get("version")
+        if method == "latest_version":
+            yield {"result": await self.call(self.db.latest_version)}
+        elif method == "get":
+            value = await self.call(
+                self.db.get, version, params["store_key"], decode_hex(params["key"])
+            )
+            yield {"result": encode_hex(value)}
+        elif method == "multi_get":
+            if "pairs" in params:
+                pairs = [(sk, decode_hex(k)) for sk, k in params["pairs"]]
+            else:
+                pairs = [(params["store_key"], decode_hex(k)) for k in params["keys"]]
+            values = await self.call(self.db.multi_get_stores, version, pairs)
+            yield {"result": [encode_hex(v) for v in values]}
+        elif method == "metrics":
+            metrics = self.db.metrics
+            yield {"result": metrics.to_prometheus() if metrics is not None else None}
+        elif method == "iterator":
+            async for page in self.iterator(version, params):
+                yield page
+        else:
+            raise ValueError(f"unknown method: {method}")
+
+    async def iterator(self, version, params: dict):
+        it = await self.call(
+            self.db.iterator,
+            version,
+            params["store_key"],
+            decode_hex(params.get("start")),
+            reverse=params.get("reverse", False),
+            end=decode_hex(params.get("end")),
+            limit=params.get("limit"),
+        )
+        page_size = params.get("page_size") or self.page_size
+        while True:
+            page = await self.call(lambda: list(itertools.islice(it, page_size)))
+            done = len(page) < page_size
+            yield {
+                "result": [[k.hex(), v.hex()] for k, v in page],
+                "done": done,
+            }
+            if done:
+                break
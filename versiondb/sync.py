@@ -1,4 +1,15 @@
-from cprotobuf import Field, ProtoEntity, decode_primitive
+import ctypes
+import ctypes.util
+import mmap
+import os
+import select
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Optional
+
+from cprotobuf import Field, ProtoEntity, decode_primitive, encode_primitive
 
 from .versiondb import KVPair
 
@@ -14,38 +25,302 @@ class StoreKVPairs(ProtoEntity):
     def to_kvpair(self):
         return KVPair(self.store_key, self.key, self.value if not self.delete else None)
 
+    @classmethod
+    def from_kvpair(cls, pair: KVPair):
+        item = cls()
+        item.store_key = pair.store_key
+        item.key = pair.key
+        if pair.value is None:
+            item.delete = True
+        else:
+            item.value = pair.value
+        return item
+
+
+def encode_stream_file(items) -> bytes:
+    """
+    the reverse of decode_stream_file
+    """
+    chunks = []
+    for item in items:
+        bz = item.SerializeToString()
+        chunks.append(encode_primitive("uint64", len(bz)))
+        chunks.append(bz)
+    body = b"".join(chunks)
+    return len(body).to_bytes(8, "big") + body
+
+
+def iter_stream_entries(data, entry_cls=StoreKVPairs):
+    """
+    decode StoreKVPairs, StoreKVPairs, ... lazily from a buffer,
+    the records are sliced through memoryview to avoid copying the buffer.
+    """
+    with memoryview(data) as buf:
+        assert int.from_bytes(buf[:8], "big") + 8 == len(buf), "incomplete file"
+
+        offset = 8
+        while offset < len(buf):
+            size, n = decode_primitive(buf[offset : offset + 10], "uint64")
+            offset += n
+            item = entry_cls()
+            item.ParseFromString(buf[offset : offset + size])
+            yield item
+            offset += size
+
 
 def decode_stream_file(data, entry_cls=StoreKVPairs):
     """
     StoreKVPairs, StoreKVPairs, ...
     """
-    assert int.from_bytes(data[:8], "big") + 8 == len(data), "incomplete file"
+    return list(iter_stream_entries(data, entry_cls))
+
+
+def open_stream_file(path, entry_cls=StoreKVPairs):
+    """
+    memory-map the file and return a generator of the decoded entries,
+    raise FileNotFoundError eagerly if the file don't exist.
+    """
+    fp = open(path, "rb")
 
-    items = []
-    offset = 8
-    while offset < len(data):
-        size, n = decode_primitive(data[offset:], "uint64")
-        offset += n
-        item = entry_cls()
-        item.ParseFromString(data[offset : offset + size])
-        items.append(item)
-        offset += size
-    return items
+    def gen():
+        with fp:
+            if os.fstat(fp.fileno()).st_size < 8:
+                # can't mmap an empty file
+                raise AssertionError("incomplete file")
+            with mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                yield from iter_stream_entries(mm, entry_cls)
 
+    return gen()
 
-def sync_local(path, versiondb):
+
+def block_file(path, version) -> Path:
+    return Path(path) / f"block-{version}-data"
+
+
+def block_ready(file) -> bool:
+    """
+    the file exists and is completely written, the streamer could be still
+    writing it, the size is checked against the length header.
+    """
+    try:
+        with open(file, "rb") as fp:
+            size = os.fstat(fp.fileno()).st_size
+            if size < 8:
+                return False
+            return int.from_bytes(fp.read(8), "big") + 8 == size
+    except FileNotFoundError:
+        return False
+
+
+def load_block(path, version):
+    """read and decode the changeset of a block,
+    return None if the file don't exist yet or is not completely written.
+
+    it's a module level function so it can run in worker processes.
+    """
+    file = block_file(path, version)
+    if not block_ready(file):
+        return None
+    return [item.to_kvpair() for item in open_stream_file(file)]
+
+
+def sync_local(path, versiondb, workers=0, prefetch=None, stop=None, executor=None):
     """load changeset from file streamer output to versiondb
 
-    file streamer outputs start with block 1.
+    file streamer outputs start with block 1, the incomplete files are treated
+    as not ready.
+
+    with workers > 0, the block files are read and decoded in a process pool
+    ahead of the writer, at most `prefetch` blocks in flight, the writes are
+    still committed in strict version order. the pool can be given as
+    `executor` to reuse it across the calls.
+
+    `stop` is a `threading.Event` checked between the blocks, a block is always
+    committed as a whole.
+
+    return the number of blocks synced.
     """
     version = (versiondb.latest_version() or 0) + 1
-    while True:
-        try:
-            items = decode_stream_file(
-                open(path / f"block-{version}-data", "rb").read()
+    if executor is None and workers <= 0:
+        count = 0
+        while stop is None or not stop.is_set():
+            file = block_file(path, version)
+            if not block_ready(file):
+                break
+            items = open_stream_file(file)
+            # stream the entries into put without materializing the block
+            versiondb.put(version, (item.to_kvpair() for item in items))
+            version += 1
+            count += 1
+        return count
+
+    if not prefetch:
+        prefetch = max(workers, 1) * 2
+    if executor is None:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            return sync_pipelined(path, versiondb, version, executor, prefetch, stop)
+    return sync_pipelined(path, versiondb, version, executor, prefetch, stop)
+
+
+def sync_pipelined(path, versiondb, version, executor, prefetch, stop=None):
+    "only the existing files are submitted, the pool is not flooded by the probes"
+    count = 0
+    pending = deque()
+    next_version = version
+    try:
+        while stop is None or not stop.is_set():
+            # keep the bounded queue filled
+            while len(pending) < prefetch and block_file(path, next_version).exists():
+                pending.append(executor.submit(load_block, path, next_version))
+                next_version += 1
+            if not pending:
+                break
+
+            items = pending.popleft().result()
+            if items is None:
+                break
+            versiondb.put(version, items)
+            version += 1
+            count += 1
+    finally:
+        for fut in pending:
+            fut.cancel()
+    return count
+
+
+# inotify events of the files created, written or moved into the directory
+IN_MODIFY = 0x2
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+
+
+class DirWatcher:
+    """
+    wait for the changes in a directory with inotify on linux,
+    or sleep for the timeout if it's not available.
+    """
+
+    def __init__(self, path):
+        self.fd = None
+        libc_name = ctypes.util.find_library("c")
+        libc = ctypes.CDLL(libc_name, use_errno=True) if libc_name else None
+        if libc is None or not hasattr(libc, "inotify_init1"):
+            return
+        fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if fd < 0:
+            return
+        mask = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+        if libc.inotify_add_watch(fd, os.fsencode(path), mask) < 0:
+            os.close(fd)
+            return
+        self.fd = fd
+
+    def wait(self, timeout: float, stop: threading.Event):
+        "return early if stop is set, it's noticed within the timeout with inotify"
+        if self.fd is None:
+            stop.wait(timeout)
+            return
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if readable:
+            # drain the events, only the wake up matters
+            try:
+                while os.read(self.fd, 65536):
+                    pass
+            except BlockingIOError:
+                pass
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+def newest_block(path, version: int) -> int:
+    """
+    find the newest block file after `version` with exponential and binary
+    probing, in O(log(lag)) stat calls, assume the files are contiguous.
+    """
+    step = 1
+    while block_file(path, version + step).exists():
+        step *= 2
+    lo, hi = version + step // 2, version + step
+    # lo exists (or is the base version), hi don't
+    while hi - lo > 1:
+        mid = (lo + hi) // 2
+        if block_file(path, mid).exists():
+            lo = mid
+        else:
+            hi = mid
+    return lo
+
+
+def follow(
+    path,
+    versiondb,
+    workers=0,
+    prefetch=None,
+    poll_interval: float = 1.0,
+    stop: Optional[threading.Event] = None,
+    metrics_file=None,
+):
+    """
+    keep syncing the new blocks until `stop` is set, wait for the new files with
+    inotify, the directory is also polled every `poll_interval` seconds.
+
+    the lag behind the newest file is reported to the metrics of versiondb, and
+    written to `metrics_file` in prometheus text format after every round if
+    given.
+
+    the process pool of the workers is kept for the whole run.
+
+    return the number of blocks synced.
+    """
+    if stop is None:
+        stop = threading.Event()
+    executor = ProcessPoolExecutor(max_workers=workers) if workers > 0 else None
+    # watch before the first sync, so no file is missed.
+    watcher = DirWatcher(path)
+    total = 0
+    try:
+        while not stop.is_set():
+            count = sync_local(
+                path, versiondb, workers, prefetch, stop=stop, executor=executor
             )
-        except FileNotFoundError:
-            break
-        items = [item.to_kvpair() for item in items]
-        versiondb.put(version, items)
-        version += 1
+            total += count
+
+            metrics = versiondb.metrics
+            if metrics is not None:
+                latest = versiondb.latest_version() or 0
+                metrics.incr("sync_blocks", count)
+                metrics.set("sync_latest_version", latest)
+                metrics.set("sync_lag_blocks", newest_block(path, latest) - latest)
+                if metrics_file is not None:
+                    metrics.write_textfile(metrics_file)
+
+            if count == 0:
+                watcher.wait(poll_interval, stop)
+    finally:
+        watcher.close()
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+    return total
+
+
+def prune_loop(
+    versiondb, keep_versions: int, interval: float, stop: threading.Event
+) -> int:
+    """
+    prune the versions older than the latest `keep_versions` every `interval`
+    seconds until `stop` is set, it runs in a thread next to the ingestion of the
+    same process, prune only holds the write lock for one batch at a time.
+
+    return the number of records pruned.
+    """
+    total = 0
+    while not stop.wait(interval):
+        latest = versiondb.latest_version()
+        if latest is None or latest - keep_versions <= versiondb.pruned_version():
+            continue
+        total += versiondb.prune(latest - keep_versions)
+    return total
@@ -1,6 +1,6 @@
 import itertools
 from collections.abc import Iterator
-from typing import Callable, NamedTuple, Optional
+from typing import Callable, NamedTuple, Optional, Tuple
 
 from cprotobuf import decode_primitive, encode_primitive
 from roaring64 import BitMap64
@@ -35,9 +35,68 @@ def full_key(store_key: str, key: bytes) -> bytes:
     return store_key_prefix(store_key) + key
 
 
+# the history values start with a fixed width header: magic, min and max versions,
+# followed by the serialized bitmap, so the seeks can be answered from the bounds
+# without deserializing.
+# the values written before don't have it, the magic can't be the start of a
+# serialized bitmap, which is the number of the buckets in little endian.
+HISTORY_MAGIC = b"\xff\xffvh"
+HISTORY_HEADER_SIZE = len(HISTORY_MAGIC) + 16
+
+
+def encode_history(bm: BitMap64) -> bytes:
+    if not bm:
+        return bm.serialize()
+    return (
+        HISTORY_MAGIC
+        + bm[0].to_bytes(8, "big")
+        + bm[len(bm) - 1].to_bytes(8, "big")
+        + bm.serialize()
+    )
+
+
+def history_bounds(v: bytes) -> Optional[Tuple[int, int]]:
+    "the min and max versions in the header, None if in the old format"
+    if v[: len(HISTORY_MAGIC)] != HISTORY_MAGIC:
+        return None
+    offset = len(HISTORY_MAGIC)
+    return (
+        int.from_bytes(v[offset : offset + 8], "big"),
+        int.from_bytes(v[offset + 8 : offset + 16], "big"),
+    )
+
+
+def decode_history(v: bytes) -> BitMap64:
+    "decode the history value in either format"
+    if v[: len(HISTORY_MAGIC)] == HISTORY_MAGIC:
+        v = v[HISTORY_HEADER_SIZE:]
+    return BitMap64.deserialize(v)
+
+
+def seek_header(v: bytes, version: int, sharded: bool) -> Tuple[bool, Optional[int]]:
+    """
+    try to answer seek_bitmap with the header of the history value,
+    return (answered, result).
+
+    with sharded history, the smaller versions could be in the archived shards,
+    only the max version is conclusive.
+    """
+    bounds = history_bounds(v)
+    if bounds is None:
+        return False, None
+    lo, hi = bounds
+    if hi <= version:
+        # no change after the version
+        return True, None
+    if lo > version and not sharded:
+        # no history before the version
+        return True, lo
+    return False, None
+
+
 def get_bitmap(history, key: bytes) -> BitMap64:
     v = history.get(key)
-    return BitMap64.deserialize(v) if v else None
+    return decode_history(v) if v else None
 
 
 def set_bitmap(history, key: bytes, version: int) -> BitMap64:
@@ -60,10 +119,38 @@ def seek_bitmap(bitmap: BitMap64, version: int) -> Optional[int]:
     return bitmap[i]
 
 
+def iter_bitmap_from(bitmap: BitMap64, version: int) -> Iterator[int]:
+    "iterate the numbers in bitmap that are larger or equal to version"
+    i = bitmap.rank(version - 1) if version > 0 else 0
+    for i in range(i, len(bitmap)):
+        yield bitmap[i]
+
+
 def changeset_key(version: int, key: bytes) -> bytes:
     return version.to_bytes(8, "big") + key
 
 
+def split_full_key(key: bytes) -> Tuple[str, bytes]:
+    "the reverse of full_key"
+    store_key, _, key = key[len(b"s/k:") :].partition(b"/")
+    return store_key.decode(), key
+
+
+# the archived history shards, separated from the current bitmaps which are
+# stored under the full key, so the scans on the latter are not disturbed.
+SHARD_PREFIX = b"h/"
+
+
+def shard_key_prefix(key: bytes) -> bytes:
+    # length prefixed, so the shards of one key are not interleaved with others.
+    return SHARD_PREFIX + len(key).to_bytes(4, "big") + key
+
+
+def shard_key(key: bytes, version: int) -> bytes:
+    "version is the upper bound of the versions in the shard"
+    return shard_key_prefix(key) + version.to_bytes(8, "big")
+
+
 def incr_bytes(prefix: bytes) -> bytes:
     bz = list(prefix)
     while bz:
@@ -75,6 +162,93 @@ def incr_bytes(prefix: bytes) -> bytes:
     return bytes(bz)
 
 
+def iterator_bounds(
+    prefix: bytes, start: Optional[bytes], end: Optional[bytes], reverse: bool
+) -> Tuple[bytes, bytes]:
+    """
+    the [lower, upper) bounds of the full keys, start is inclusive and end is
+    exclusive in the iteration order, like `prefix_iteritems`.
+    """
+    if reverse:
+        start, end = end, start
+        # the next keys after the inclusive upper and exclusive lower
+        lower = prefix + start + b"\x00" if start else prefix
+        upper = prefix + end + b"\x00" if end else incr_bytes(prefix)
+    else:
+        lower = prefix + start if start else prefix
+        upper = prefix + end if end else incr_bytes(prefix)
+    return lower, upper
+
+
+class BoundedIterator:
+    """
+    the rocksdb binding points the read options at the buffers of the bound
+    bytes without copying them, so they are referenced here for as long as the
+    iterator lives.
+    """
+
+    def __init__(self, it, bounds: Tuple[bytes, bytes]):
+        self.it = it
+        self.bounds = bounds
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self.it)
+
+    def __reversed__(self):
+        return BoundedIterator(reversed(self.it), self.bounds)
+
+    def get(self):
+        return self.it.get()
+
+    def seek(self, key: bytes):
+        self.it.seek(key)
+
+    def seek_for_prev(self, key: bytes):
+        self.it.seek_for_prev(key)
+
+    def seek_to_first(self):
+        self.it.seek_to_first()
+
+    def seek_to_last(self):
+        self.it.seek_to_last()
+
+
+def open_bounded(store, lower: bytes, upper: bytes, **kwargs) -> BoundedIterator:
+    "iterate the keys in [lower, upper) of the store"
+    it = store.iteritems(iterate_lower_bound=lower, iterate_upper_bound=upper, **kwargs)
+    return BoundedIterator(it, (lower, upper))
+
+
+def bounded_iteritems(
+    store,
+    prefix: bytes,
+    start: Optional[bytes] = None,
+    end: Optional[bytes] = None,
+    reverse: bool = False,
+    **kwargs,
+):
+    """
+    open an iterator of the store bounded with iterate_lower_bound and
+    iterate_upper_bound, so the engine stops at the boundary, and position it at
+    the first item in the iteration order, the keys are not stripped.
+    """
+    lower, upper = iterator_bounds(prefix, start, end, reverse)
+    it = open_bounded(store, lower, upper, **kwargs)
+    if reverse:
+        it = reversed(it)
+        it.seek_to_last()
+    else:
+        it.seek(lower)
+    return it
+
+
+def strip_prefix(it, n: int):
+    return ((k[n:], v) for k, v in it)
+
+
 def prefix_iteritems(
     it: Iterator, prefix: bytes, reverse: bool = False, end: Optional[bytes] = None
 ):
@@ -0,0 +1,58 @@
+"""
+compare the query results of two versiondbs, for example the ones written with
+and without the history merge operator.
+"""
+
+from typing import Iterable, Iterator, List, Optional
+
+from .utils import prefix_iteritems
+from .versiondb import VersionDB
+
+
+def store_keys(db: VersionDB, store_key: str) -> List[bytes]:
+    "all the keys ever existed in the store"
+    prefix = db.codec.prefix(store_key)
+    keys = set()
+    for store in (db.plain, db.history):
+        it = store.iteritems()
+        it.seek(prefix)
+        keys.update(k for k, _ in prefix_iteritems(it, prefix))
+    return sorted(keys)
+
+
+def compare_dbs(
+    db1: VersionDB,
+    db2: VersionDB,
+    stores: Iterable[str],
+    versions: Optional[Iterable[int]] = None,
+) -> Iterator[str]:
+    """
+    yield the description of the differences in get and iterator results,
+    check all the versions by default.
+    """
+    latest = db1.latest_version()
+    if latest != db2.latest_version():
+        yield f"latest version: {latest} != {db2.latest_version()}"
+        return
+    if versions is None:
+        versions = range(latest + 1) if latest is not None else []
+    versions = list(versions)
+
+    for store_key in stores:
+        keys = store_keys(db1, store_key)
+        if keys != store_keys(db2, store_key):
+            yield f"{store_key}: different key sets"
+        for version in versions:
+            values1 = db1.multi_get(version, store_key, keys)
+            values2 = db2.multi_get(version, store_key, keys)
+            for key, v1, v2 in zip(keys, values1, values2):
+                if v1 != v2:
+                    yield f"get {store_key} {key} at {version}: {v1} != {v2}"
+                if v1 != db1.get(version, store_key, key):
+                    yield f"multi_get {store_key} {key} at {version} != get"
+
+            for reverse in (False, True):
+                items1 = list(db1.iterator(version, store_key, reverse=reverse))
+                items2 = list(db2.iterator(version, store_key, reverse=reverse))
+                if items1 != items2:
+                    yield f"iterator {store_key} at {version} reverse={reverse}"
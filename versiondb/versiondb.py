@@ -1,31 +1,156 @@
+import itertools
+import json
+import tempfile
+import threading
+from contextlib import contextmanager
 from pathlib import Path
-from typing import List, Optional
+from typing import Iterable, Iterator, List, NamedTuple, Optional, Tuple
 
 import rocksdb
+from roaring64 import BitMap64
 
+from . import bulk, options, rocksdb_cf
+from .cache import MISSING, LRUCache
+from .codec import CODEC_TEXT, KEY_CODEC_KEY, open_codec
 from .iterator import VersionDBIter
-from .utils import (KVPair, changeset_key, decode_stdint64, encode_stdint64,
-                    full_key, get_bitmap, incr_bytes, prefix_iteritems,
-                    seek_bitmap, set_bitmap, store_key_prefix)
+from .lmdbstore import DEFAULT_MAP_SIZE, LMDBStore, TxnStore, open_env
+from .metrics import Metrics
+from .rocksdb_cf import CFBatch, ColumnFamily
+from .utils import (KVPair, bounded_iteritems, changeset_key, decode_history,
+                    decode_stdint64, encode_history, encode_stdint64,
+                    get_bitmap, history_bounds, incr_bytes, iter_bitmap_from,
+                    seek_bitmap, seek_header, shard_key, shard_key_prefix,
+                    strip_prefix)
 
 LATEST_VERSION_KEY = b"s/latest"
+# record the history shard size if the history is sharded
+HISTORY_SHARD_SIZE_KEY = b"s/history-shard-size"
+# the versions before it are pruned
+PRUNED_VERSION_KEY = b"s/pruned"
+# the changesets up to it are deleted and the history trimmed, the next prune
+# starts after it.
+PRUNED_CHANGESETS_KEY = b"s/pruned-changesets"
+# recorded by the dbs created with the creations in the changesets, so the
+# changesets cover every version in the history bitmaps.
+CHANGESET_CREATIONS_KEY = b"s/changeset-creations"
+
+# the integer rocksdb properties of the stores in store_properties
+ROCKSDB_PROPERTIES = (
+    "estimate-num-keys",
+    "cur-size-all-mem-tables",
+    "estimate-pending-compaction-bytes",
+    "total-sst-files-size",
+)
+
+# the modes to open the rocksdb databases, see `VersionDB.open_rocksdb`
+MODE_READWRITE = "readwrite"
+MODE_READONLY = "readonly"
+MODE_SECONDARY = "secondary"
+
+# three rocksdb instances: plain.db, changeset.db, history.db
+LAYOUT_SEPARATE = "separate"
+# one rocksdb instance with three column families: versiondb.db
+LAYOUT_CF = "cf"
+CF_DB_NAME = "versiondb.db"
+
+# written last into the checkpoint directory, a checkpoint without it is incomplete
+CHECKPOINT_MANIFEST = "checkpoint.json"
+
+
+class VersionPrunedError(Exception):
+    pass
 
 
 class DB:
     pass
 
 
+class Batches(NamedTuple):
+    plain: object
+    changeset: object
+    history: object
+
+
+class Change(NamedTuple):
+    version: int
+    store_key: str
+    key: bytes
+    # None means not exist
+    old_value: Optional[bytes]
+    new_value: Optional[bytes]
+
+
+class KeyChange(NamedTuple):
+    version: int
+    # None means not exist
+    old_value: Optional[bytes]
+    new_value: Optional[bytes]
+
+
+class Snapshot(NamedTuple):
+    plain: object
+    changeset: object
+    history: object
+
+
 class VersionDB:
+    """
+    the empty values are not supported, the empty value is not distinguished
+    from not exist in the changeset, only the latest state keeps it.
+    """
+
     plain: DB
     changeset: DB
     history: DB
 
     _is_rocksdb: bool
+    # the rocksdb instance when the stores are column families of it
+    shared_db: Optional[rocksdb.DB]
 
-    def __init__(self, plain: DB, changeset: DB, history: DB):
+    # optional cache of deserialized history bitmaps and the latest version,
+    # only valid if all the writes go through this instance.
+    bitmap_cache: Optional[LRUCache]
+    _latest_version: object
+
+    # the versions before it are pruned
+    _pruned_version: int
+
+    # split the history bitmap of a key into shards of this many versions,
+    # 0 means not sharded.
+    history_shard_size: int
+    # if any history shards have been written to the db
+    _sharded: bool
+
+    # append to history bitmaps with the merge operator, instead of
+    # read-modify-write.
+    merge_history: bool
+
+    def __init__(
+        self,
+        plain: DB,
+        changeset: DB,
+        history: DB,
+        cache_size: int = 0,
+        history_shard_size: int = 0,
+        merge_history: bool = False,
+        metrics: Optional[Metrics] = None,
+        key_codec: Optional[str] = None,
+    ):
         self.plain = plain
         self.changeset = changeset
         self.history = history
+        self.shared_db = plain.db if isinstance(plain, ColumnFamily) else None
+
+        self.bitmap_cache = LRUCache(cache_size) if cache_size > 0 else None
+        self._latest_version = MISSING
+        # bumped by catch_up, the values read before it are not cached
+        self._cache_generation = 0
+        self._refresh_stop = None
+
+        # serialize the writers in the process, held for one block or one batch.
+        self._write_lock = threading.Lock()
+        self.history_shard_size = history_shard_size
+        self._load_meta()
 
         try:
             self.plain.write
@@ -34,89 +159,666 @@ class VersionDB:
         else:
             self._is_rocksdb = True
 
+        assert not merge_history or self._is_rocksdb, "merge requires rocksdb"
+        assert not (
+            merge_history and history_shard_size
+        ), "merge is not compatible with sharded history"
+        self.merge_history = merge_history
+        self.metrics = metrics
+        self.codec = open_codec(
+            plain, key_codec, fresh=plain.get(LATEST_VERSION_KEY) is None
+        )
+
     @classmethod
-    def open_rocksdb(cls, path):
-        path = Path(path)
+    def open_lmdb(
+        cls,
+        path,
+        map_size: int = DEFAULT_MAP_SIZE,
+        read_only: bool = False,
+        **kwargs,
+    ):
+        env = open_env(path, map_size, readonly=read_only)
         return cls(
-            rocksdb.DB(str(path / "plain.db"), rocksdb.Options(create_if_missing=True)),
-            rocksdb.DB(
-                str(path / "changeset.db"), rocksdb.Options(create_if_missing=True)
-            ),
-            rocksdb.DB(
-                str(path / "history.db"), rocksdb.Options(create_if_missing=True)
-            ),
+            LMDBStore(env, b"plain"),
+            LMDBStore(env, b"changeset"),
+            LMDBStore(env, b"history"),
+            **kwargs,
         )
 
+    @classmethod
+    def open_rocksdb(
+        cls,
+        path,
+        layout: Optional[str] = None,
+        profile: Optional[str] = None,
+        tuning: Optional[dict] = None,
+        read_only: bool = False,
+        mode: Optional[str] = None,
+        secondary_path=None,
+        refresh_interval: float = 0,
+        **kwargs,
+    ):
+        """
+        layout is detected from the existing files if not specified,
+        new databases default to the separate layout.
+
+        mode is one of:
+        - readwrite: the default, take the lock, only one process can open it.
+        - readonly: don't take the lock, so it can be opened next to a writer
+          process, but it don't see the writes after opened, read_only=True is
+          the same.
+        - secondary: don't take the lock, follow the writes of the primary
+          with `catch_up`, or every `refresh_interval` seconds in a background
+          thread, the info logs are written into `secondary_path`, a temporary
+          directory by default.
+
+        profile selects one of the tuning profiles in `options.PROFILES`,
+        tuning overrides the individual settings of it.
+
+        the merge operator is always installed on history, so the databases
+        written with merge_history can be opened either way.
+
+        the other arguments are passed to the constructor.
+        """
+        if mode is None:
+            mode = MODE_READONLY if read_only else MODE_READWRITE
+        assert mode in (MODE_READWRITE, MODE_READONLY, MODE_SECONDARY), mode
+        path = Path(path)
+        if mode == MODE_READWRITE:
+            path.mkdir(parents=True, exist_ok=True)
+        if mode == MODE_SECONDARY and secondary_path is None:
+            secondary_path = tempfile.mkdtemp(prefix="versiondb-secondary-")
+        if layout is None:
+            layout = detect_layout(path)
+        config = options.resolve_config(profile, tuning)
+        if mode == MODE_SECONDARY:
+            # required by the secondary instance
+            config["max_open_files"] = -1
+        cache = options.shared_cache(config)
+
+        def open_kwargs(name: str) -> dict:
+            if mode == MODE_READONLY:
+                return {"read_only": True}
+            if mode == MODE_SECONDARY:
+                return {"secondary_path": str(Path(secondary_path) / name)}
+            return {}
+
+        if layout == LAYOUT_CF:
+            db = rocksdb_cf.open_db(
+                path / CF_DB_NAME,
+                options.db_options(config, create_missing_column_families=True),
+                {
+                    name.encode(): options.cf_options(config, name, cache)
+                    for name in options.STORES
+                },
+                **open_kwargs(CF_DB_NAME),
+            )
+            stores = (
+                ColumnFamily(db, b"plain"),
+                ColumnFamily(db, b"changeset"),
+                ColumnFamily(db, b"history"),
+            )
+        else:
+            assert layout == LAYOUT_SEPARATE, f"unknown layout: {layout}"
+            stores = (
+                rocksdb.DB(
+                    str(path / f"{name}.db"),
+                    options.store_options(config, name, cache),
+                    **open_kwargs(f"{name}.db"),
+                )
+                for name in options.STORES
+            )
+        db = cls(*stores, **kwargs)
+        if refresh_interval > 0:
+            assert mode == MODE_SECONDARY, "refresh requires secondary mode"
+            db.start_refresh(refresh_interval)
+        return db
+
     def get(self, version: Optional[int], store_key: str, key: bytes) -> bytes:
+        if self.metrics is None:
+            return self._get(version, store_key, key)
+        with self.metrics.timer("get_seconds"):
+            return self._get(version, store_key, key)
+
+    def _get(self, version: Optional[int], store_key: str, key: bytes) -> bytes:
         if version is not None and version == self.latest_version():
             version = None
+        self._check_pruned(version)
 
-        key = full_key(store_key, key)
+        key = self.codec.full_key(store_key, key)
 
-        if version is None:
-            return self.plain.get(key)
+        v = None
+        if version is not None and self.bitmap_cache is None:
+            # find in historical changeset, try the header first
+            raw = self.history.get(key)
+            if raw:
+                v = self.seek_history_value(key, raw, version)
+        elif version is not None:
+            bitmap = self.get_bitmap(key)
+            if bitmap:
+                v = self.seek_history(key, bitmap, version)
+
+        if self.metrics is not None:
+            self.metrics.incr("get_total")
+            self.metrics.incr(
+                "get_plain_fallbacks" if v is None else "get_changeset_hits"
+            )
 
-        # find in historical changeset
-        bitmap = get_bitmap(self.history, key)
-        if not bitmap:
-            return self.plain.get(key)
-        v = seek_bitmap(bitmap, version)
         if v is None:
             return self.plain.get(key)
+        # lookup in changeset db, empty value means not exist
+        return self.changeset.get(changeset_key(v, key)) or None
 
-        # lookup in changeset db
-        return self.changeset.get(changeset_key(v, key))
+    def multi_get(
+        self, version: Optional[int], store_key: str, keys: List[bytes]
+    ) -> List[Optional[bytes]]:
+        "batched version of get, return the values in input order"
+        return self.multi_get_stores(version, [(store_key, key) for key in keys])
 
-    def put(self, version: int, change_set: List[KVPair]):
-        if self._is_rocksdb:
-            # rocksdb
-            self.put_batch(version, change_set)
+    def multi_get_stores(
+        self, version: Optional[int], pairs: List[Tuple[str, bytes]]
+    ) -> List[Optional[bytes]]:
+        "like multi_get, but take (store_key, key) pairs across stores"
+        if version is not None and version == self.latest_version():
+            version = None
+        self._check_pruned(version)
+        queries = [
+            (version, self.codec.full_key(store_key, key)) for store_key, key in pairs
+        ]
+        if self.metrics is None:
+            return self._resolve(queries)
+        with self.metrics.timer("multi_get_seconds"):
+            return self._resolve(queries)
+
+    def _resolve(
+        self, queries: List[Tuple[Optional[int], bytes]]
+    ) -> List[Optional[bytes]]:
+        """
+        resolve (version, full key) queries in three bulk phases:
+        history bitmaps, changeset for the keys found in history,
+        plain state for the rest.
+        """
+        keys = list({key: None for version, key in queries if version is not None})
+        if self.bitmap_cache is None:
+            # raw values, try the headers before deserializing
+            values = self.history.multi_get(keys) if keys else {}
+            bitmaps = {}
         else:
-            # lmdb
-            self.put_transactional(version, change_set)
-
-    def put_batch(self, version: int, change_set: List[KVPair]):
-        plain_batch = rocksdb.WriteBatch()
-        history_batch = rocksdb.WriteBatch()
-        changeset_batch = rocksdb.WriteBatch()
-        for item in change_set:
-            key = full_key(item.store_key, item.key)
-
-            if version == 0:
-                # write genesis state into plain state directly
-                assert item.value is not None, "can't delete in genesis state"
-                plain_batch.put(key, item.value)
-                continue
+            values = {}
+            bitmaps = self.multi_get_bitmaps(keys)
 
-            original = self.plain.get(key)
-            if original == item.value:
-                continue
+        targets = []
+        changeset_keys = []
+        plain_keys = []
+        for version, key in queries:
+            found = None
+            if version is not None:
+                raw = values.get(key)
+                bitmap = bitmaps.get(key)
+                if raw:
+                    found = self.seek_history_value(key, raw, version)
+                elif bitmap:
+                    found = self.seek_history(key, bitmap, version)
+            if found is None:
+                targets.append((False, key))
+                plain_keys.append(key)
+            else:
+                target = changeset_key(found, key)
+                targets.append((True, target))
+                changeset_keys.append(target)
+
+        if self.metrics is not None:
+            self.metrics.incr("get_total", len(queries))
+            self.metrics.incr("get_changeset_hits", len(changeset_keys))
+            self.metrics.incr("get_plain_fallbacks", len(plain_keys))
+
+        changeset_values = (
+            self.changeset.multi_get(changeset_keys) if changeset_keys else {}
+        )
+        plain_values = self.plain.multi_get(plain_keys) if plain_keys else {}
+        return [
+            (
+                (changeset_values.get(key) or None)
+                if is_changeset
+                else plain_values.get(key)
+            )
+            for is_changeset, key in targets
+        ]
+
+    def put(self, version: int, change_set: Iterable[KVPair]):
+        if self.metrics is None:
+            return self._put(version, change_set)
+        with self.metrics.timer("put_seconds"):
+            return self._put(version, change_set)
+
+    def _put(self, version: int, change_set: Iterable[KVPair]):
+        with self._write_lock:
+            if self._is_rocksdb:
+                # rocksdb
+                self.put_batch(version, change_set)
+            else:
+                # lmdb
+                self.put_transactional(version, change_set)
+
+    def put_batch(self, version: int, change_set: Iterable[KVPair]):
+        with self.write_batches() as batches:
+            changed = self._write_change_set(
+                version,
+                change_set,
+                self.plain,
+                self.history,
+                batches.plain,
+                batches.changeset,
+                batches.history,
+            )
+        self._invalidate_cache(version, changed)
+
+    def put_transactional(self, version: int, change_set: Iterable[KVPair]):
+        with self.write_batches() as batches:
+            changed = self._write_change_set(
+                version,
+                change_set,
+                batches.plain,
+                batches.history,
+                batches.plain,
+                batches.changeset,
+                batches.history,
+            )
+        self._invalidate_cache(version, changed)
+
+    def bulk_load(
+        self,
+        pairs: Iterable[KVPair],
+        run_size: int = bulk.DEFAULT_RUN_SIZE,
+        tmp_dir=None,
+        sst_options=None,
+        sst_size: int = bulk.DEFAULT_SST_SIZE,
+    ) -> int:
+        """
+        load the genesis state (version 0) into a fresh db, an alternative to
+        `put(0, pairs)` for the large states.
 
-            # write histroy index
-            bm = set_bitmap(self.history, key, version)
-            history_batch.put(key, bm.serialize())
+        the pairs don't need to be sorted, they are sorted in runs of `run_size`
+        pairs spilled into `tmp_dir`, which should be on the same filesystem as
+        the db, so the sst files are moved into rocksdb by hard links.
+        if the rocksdb binding can't write sst files, the sorted pairs are
+        written in write batches instead.
 
-            # write changeset record
-            if original is not None:
-                changeset_batch.put(changeset_key(version, key), original)
+        `sst_options` are the rocksdb options to write the sst files, should
+        match the ones of plain.
 
-            if item.value is None:
-                plain_batch.delete(key)
+        return the number of records loaded.
+        """
+        with self._write_lock:
+            assert self.latest_version() is None, "bulk load into a fresh db only"
+            try:
+                return self._bulk_load(pairs, run_size, tmp_dir, sst_options, sst_size)
+            except BaseException:
+                # the store ids registered in the sort
+                self.codec.rollback()
+                raise
+
+    def _bulk_load(self, pairs, run_size, tmp_dir, sst_options, sst_size) -> int:
+        "called with the write lock held"
+        records = []
+
+        def encode():
+            for item in pairs:
+                assert item.value is not None, "can't delete in genesis state"
+                record = self.codec.register(item.store_key)
+                if record is not None:
+                    records.append(record)
+                yield self.codec.full_key(item.store_key, item.key), item.value
+
+        with tempfile.TemporaryDirectory(prefix="versiondb-bulk-", dir=tmp_dir) as tmp:
+            merged = bulk.sort_pairs(encode(), run_size, tmp)
+            if self._is_rocksdb and bulk.HAS_SST_WRITER:
+                files, count = bulk.write_sst_files(merged, tmp, sst_options, sst_size)
+                if files:
+                    self.plain.ingest_external_file(files, move_files=True)
+            elif self._is_rocksdb:
+                count = self._write_sorted(merged)
             else:
+                count = self.plain.append_sorted(merged)
+
+        # the latest version is written last, an interrupted load is not
+        # taken as the genesis.
+        with self.write_batches() as batches:
+            for record in records:
+                batches.plain.put(*record)
+            self._write_change_set(
+                0, [], None, None, batches.plain, batches.changeset, None
+            )
+        self._invalidate_cache(0, [])
+        return count
+
+    def _write_sorted(
+        self, pairs: Iterator[Tuple[bytes, bytes]], batch_size=bulk.DEFAULT_BATCH_SIZE
+    ) -> int:
+        """
+        write the sorted pairs into plain in batches of bounded size, the store
+        ids are left to the caller, return the number of pairs written.
+        """
+        count = 0
+        while True:
+            chunk = list(itertools.islice(pairs, batch_size))
+            if not chunk:
+                return count
+            batch = rocksdb.WriteBatch()
+            target = batch if self.shared_db is None else CFBatch(batch, self.plain)
+            for key, value in chunk:
+                target.put(key, value)
+            self.plain.write(batch)
+            count += len(chunk)
+
+    @contextmanager
+    def write_batches(self) -> Iterator[Batches]:
+        """
+        the write batches of the stores, committed when the block exits
+        without error.
+
+        for lmdb, they are the stores inside a write transaction, so they can
+        be read from as well.
+
+        the store ids registered in the block are published after committed.
+        """
+        try:
+            with self._write_batches() as batches:
+                yield batches
+        except BaseException:
+            self.codec.rollback()
+            raise
+        self.codec.commit()
+
+    @contextmanager
+    def _write_batches(self) -> Iterator[Batches]:
+        if not self._is_rocksdb:
+            with self.plain.env.begin(write=True) as txn:
+                yield Batches(
+                    TxnStore(txn, self.plain),
+                    TxnStore(txn, self.changeset),
+                    TxnStore(txn, self.history),
+                )
+        elif self.shared_db is not None:
+            # one atomic write for all the column families
+            batch = rocksdb.WriteBatch()
+            yield Batches(
+                CFBatch(batch, self.plain),
+                CFBatch(batch, self.changeset),
+                CFBatch(batch, self.history),
+            )
+            self.shared_db.write(batch)
+        else:
+            batches = Batches(
+                rocksdb.WriteBatch(), rocksdb.WriteBatch(), rocksdb.WriteBatch()
+            )
+            yield batches
+            # plain is written last, so latest version is never ahead of the data
+            self.changeset.write(batches.changeset)
+            self.history.write(batches.history)
+            self.plain.write(batches.plain)
+
+    def _write_change_set(
+        self,
+        version: int,
+        change_set: Iterable[KVPair],
+        plain,
+        history,
+        plain_batch,
+        changeset_batch,
+        history_batch,
+    ):
+        """
+        compute the changes and write them into the batches,
+        plain and history are read from through multi_get.
+
+        return the keys whose history changed.
+        """
+        changed = []
+        if version == 0:
+            # write genesis state into plain state directly
+            for item in change_set:
+                assert item.value is not None, "can't delete in genesis state"
+                key = self.write_key(plain_batch, item.store_key, item.key)
                 plain_batch.put(key, item.value)
+        else:
+            # de-duplicate the keys, the last write wins.
+            changes = {
+                self.write_key(plain_batch, item.store_key, item.key): item.value
+                for item in change_set
+            }
+            originals = plain.multi_get(list(changes)) if changes else {}
+            changed = [
+                key for key, value in changes.items() if originals.get(key) != value
+            ]
+            if self.merge_history:
+                # blind append, folded by the merge operator
+                bitmaps = {}
+                operand = encode_history(BitMap64([version]))
+            else:
+                bitmaps = history.multi_get(changed) if changed else {}
 
+            for key in changed:
+                value = changes[key]
+                original = originals.get(key)
+
+                # write histroy index
+                if self.merge_history:
+                    history_batch.merge(key, operand)
+                else:
+                    raw = bitmaps.get(key)
+                    bm = decode_history(raw) if raw else BitMap64()
+                    if self.history_shard_size and len(bm) >= self.history_shard_size:
+                        # archive the full shard, the writes only touch the
+                        # current one.
+                        history_batch.put(shard_key(key, bm[len(bm) - 1]), raw)
+                        bm = BitMap64()
+                    bm.add(version)
+                    history_batch.put(key, encode_history(bm))
+
+                # write changeset record, empty value marks the creation of the
+                # key, so the changes feed is complete. so the empty values are
+                # not supported, they read as not exist in the historical
+                # versions, like the iterator always treats them.
+                changeset_batch.put(
+                    changeset_key(version, key),
+                    original if original is not None else b"",
+                )
+
+                if value is None:
+                    plain_batch.delete(key)
+                else:
+                    plain_batch.put(key, value)
+
+        if self.codec.name != CODEC_TEXT:
+            plain_batch.put(KEY_CODEC_KEY, self.codec.name.encode())
+        if self._changeset_creations:
+            plain_batch.put(CHANGESET_CREATIONS_KEY, b"1")
+        if self.history_shard_size:
+            plain_batch.put(
+                HISTORY_SHARD_SIZE_KEY, encode_stdint64(self.history_shard_size)
+            )
         plain_batch.put(LATEST_VERSION_KEY, encode_stdint64(version))
+        return changed
+
+    def write_key(self, plain_batch, store_key: str, key: bytes) -> bytes:
+        "encode the full key, and register the new store in the same batch"
+        record = self.codec.register(store_key)
+        if record is not None:
+            plain_batch.put(*record)
+        return self.codec.full_key(store_key, key)
+
+    def _invalidate_cache(self, version: int, keys: List[bytes]):
+        "called after the writes are committed"
+        if self.metrics is not None:
+            self.metrics.incr("put_blocks")
+            self.metrics.incr("put_changed_keys", len(keys))
+        if self.bitmap_cache is not None:
+            for key in keys:
+                self.bitmap_cache.pop(key)
+            self._latest_version = version
 
-        self.changeset.write(changeset_batch)
-        self.history.write(history_batch)
-        self.plain.write(plain_batch)
+    def get_bitmap(self, key: bytes) -> Optional[BitMap64]:
+        "read the history bitmap of the full key, through the cache if enabled"
+        if self.bitmap_cache is None:
+            return get_bitmap(self.history, key)
+        bm = self.bitmap_cache.get(key)
+        if bm is MISSING:
+            generation = self._cache_generation
+            bm = get_bitmap(self.history, key)
+            if generation == self._cache_generation:
+                self.bitmap_cache.put(key, bm)
+        return bm
+
+    def seek_history(
+        self, key: bytes, bitmap: BitMap64, version: int, snapshot=None
+    ) -> Optional[int]:
+        """
+        find the minimal version that is larger than the target version,
+        in the current history bitmap of the full key, or the archived shards.
+        """
+        if self._sharded and bitmap[0] > version:
+            # there could be a smaller one in the archived shards
+            found = self._seek_shards(key, version, snapshot)
+            if found is not None:
+                return found
+        return seek_bitmap(bitmap, version)
+
+    def seek_history_value(
+        self, key: bytes, value: bytes, version: int, snapshot=None
+    ) -> Optional[int]:
+        "like seek_history, but on the raw history value, try the header first"
+        answered, found = seek_header(value, version, self._sharded)
+        if answered:
+            return found
+        return self.seek_history(key, decode_history(value), version, snapshot)
+
+    def _seek_shards(self, key: bytes, version: int, snapshot=None) -> Optional[int]:
+        "locate the shard with a single seek, the first one whose upper bound > version"
+        it = self.history.iteritems(
+            **({"snapshot": snapshot} if snapshot is not None else {})
+        )
+        it.seek(shard_key(key, version + 1))
+        try:
+            k, v = next(it)
+        except StopIteration:
+            return None
+        if k[:-8] != shard_key_prefix(key):
+            return None
+        return seek_bitmap(decode_history(v), version)
 
-    def put_transactional(self, version: int, change_set: List[KVPair]):
-        raise NotImplementedError()
+    def multi_get_bitmaps(self, keys: List[bytes]) -> dict:
+        "batched version of get_bitmap, keys must be unique"
+        if self.bitmap_cache is None:
+            values = self.history.multi_get(keys) if keys else {}
+            return {key: decode_history(v) if v else None for key, v in values.items()}
+
+        result = {}
+        missing = []
+        for key in keys:
+            bm = self.bitmap_cache.get(key)
+            if bm is MISSING:
+                missing.append(key)
+            else:
+                result[key] = bm
+        if missing:
+            generation = self._cache_generation
+            for key, v in self.history.multi_get(missing).items():
+                bm = decode_history(v) if v else None
+                if generation == self._cache_generation:
+                    self.bitmap_cache.put(key, bm)
+                result[key] = bm
+        return result
+
+    def cache_stats(self) -> Optional[dict]:
+        if self.bitmap_cache is None:
+            return None
+        return self.bitmap_cache.stats()
+
+    def store_properties(self) -> dict:
+        "the size and compaction status of the stores, from the rocksdb properties"
+        result = {}
+        for name in ("plain", "changeset", "history"):
+            store = getattr(self, name)
+            if self._is_rocksdb:
+                result[name] = {
+                    prop: int(store.get_property(f"rocksdb.{prop}".encode()) or 0)
+                    for prop in ROCKSDB_PROPERTIES
+                }
+            else:
+                result[name] = store.stat()
+        return result
+
+    def rocksdb_stats(self) -> Optional[str]:
+        "the statistics dump of rocksdb, None for lmdb"
+        if not self._is_rocksdb:
+            return None
+        stats = {
+            name: getattr(self, name).get_property(b"rocksdb.stats")
+            for name in ("plain", "changeset", "history")
+        }
+        return "\n".join(
+            f"** {name} **\n{v.decode() if isinstance(v, bytes) else v}"
+            for name, v in stats.items()
+        )
 
     def latest_version(self) -> Optional[int]:
+        if self.bitmap_cache is not None and self._latest_version is not MISSING:
+            return self._latest_version
+        generation = self._cache_generation
         v = self.plain.get(LATEST_VERSION_KEY)
-        return decode_stdint64(v) if v else None
+        v = decode_stdint64(v) if v else None
+        if self.bitmap_cache is not None and generation == self._cache_generation:
+            self._latest_version = v
+        return v
+
+    def _load_meta(self):
+        "load the markers the writer could change, on open and catch up"
+        v = self.plain.get(PRUNED_VERSION_KEY)
+        self._pruned_version = decode_stdint64(v) if v else 0
+        self._sharded = self.history_shard_size > 0 or bool(
+            self.plain.get(HISTORY_SHARD_SIZE_KEY)
+        )
+        # a fresh db records the creations from the first version
+        self._changeset_creations = bool(self.plain.get(CHANGESET_CREATIONS_KEY)) or (
+            self.plain.get(LATEST_VERSION_KEY) is None
+        )
+
+    def catch_up(self):
+        """
+        follow the writes of the primary in secondary mode, and drop the caches,
+        lmdb readers see the writes anyway.
+
+        plain is caught up first, the primary writes it last, so the history and
+        changeset are at least as new as the plain state.
+        """
+        if self._is_rocksdb:
+            if self.shared_db is not None:
+                self.shared_db.try_catch_up_with_primary()
+            else:
+                for store in (self.plain, self.history, self.changeset):
+                    store.try_catch_up_with_primary()
+        self._load_meta()
+        self._cache_generation += 1
+        if self.bitmap_cache is not None:
+            self.bitmap_cache.clear()
+            self._latest_version = MISSING
+
+    def start_refresh(self, interval: float):
+        "catch up every interval seconds in a daemon thread"
+        assert self._refresh_stop is None, "already refreshing"
+        self._refresh_stop = stop = threading.Event()
+
+        def run():
+            while not stop.wait(interval):
+                self.catch_up()
+
+        threading.Thread(target=run, name="versiondb-refresh", daemon=True).start()
+
+    def stop_refresh(self):
+        if self._refresh_stop is not None:
+            self._refresh_stop.set()
+            self._refresh_stop = None
 
     def iterator(
         self,
@@ -124,24 +826,439 @@ class VersionDB:
         store_key: str,
         start: Optional[bytes] = None,
         reverse: bool = False,
+        end: Optional[bytes] = None,
+        limit: Optional[int] = None,
+        raw_keys: bool = False,
     ):
+        """
+        iterate the keys from start (inclusive) to end (exclusive) in the
+        iteration order, the bounds are enforced by the storage engine.
+
+        with raw_keys, the full keys are returned as is, to avoid the slicing
+        of every key, strip `codec.prefix(store_key)` if needed.
+        """
         if version is not None and version == self.latest_version():
             version = None
+        self._check_pruned(version)
 
         if version is None:
-            it = self.plain.iteritems()
-            prefix = store_key_prefix(store_key)
-            if reverse:
-                it = reversed(it)
-            if start:
-                full_start = prefix + start
-                it.seek(full_start)
-                if reverse and it.get()[0] > full_start:
-                    next(it)
+            prefix = self.codec.prefix(store_key)
+            it = bounded_iteritems(self.plain, prefix, start, end, reverse)
+            if not raw_keys:
+                it = strip_prefix(it, len(prefix))
+        else:
+            it = VersionDBIter(
+                self,
+                version,
+                store_key,
+                start,
+                reverse,
+                snapshot=self.snapshot(),
+                end=end,
+                raw_keys=raw_keys,
+            )
+        if limit is not None:
+            it = itertools.islice(it, limit)
+        return it
+
+    def changes(
+        self,
+        from_version: int,
+        to_version: Optional[int] = None,
+        store_key: Optional[str] = None,
+        batch_size: int = 1000,
+    ) -> Iterator[Change]:
+        """
+        yield the changes in the version range [from_version, to_version] in
+        (version, full key) order, the latest version by default.
+
+        the changes are scanned from the changeset, which is ordered by version,
+        the new values are resolved in bulk for each batch.
+
+        the dbs written by older versions don't record the creations of the keys
+        in the changeset, so they are missing from the feed.
+        """
+        # checked eagerly, before the iteration
+        self._check_pruned_changes(from_version)
+        return self._changes(from_version, to_version, store_key, batch_size)
+
+    def _changes(
+        self,
+        from_version: int,
+        to_version: Optional[int],
+        store_key: Optional[str],
+        batch_size: int,
+    ) -> Iterator[Change]:
+        if to_version is None:
+            to_version = self.latest_version()
+        if to_version is None or from_version > to_version:
+            return
+
+        if store_key is None:
+            it = self._scan_changeset(
+                changeset_key(from_version, b""), changeset_key(to_version + 1, b"")
+            )
+        else:
+            prefix = self.codec.prefix(store_key)
+            it = itertools.chain.from_iterable(
+                self._scan_changeset(
+                    changeset_key(v, prefix), changeset_key(v, incr_bytes(prefix))
+                )
+                for v in range(from_version, to_version + 1)
+            )
+
+        while True:
+            batch = list(itertools.islice(it, batch_size))
+            if not batch:
+                break
+            values = self._resolve([(version, key) for version, key, _ in batch])
+            for (version, key, old), new in zip(batch, values):
+                yield Change(version, *self.codec.split(key), old or None, new)
+
+    def key_history(
+        self,
+        store_key: str,
+        key: bytes,
+        from_version: Optional[int] = None,
+        to_version: Optional[int] = None,
+        batch_size: int = 1000,
+    ) -> Iterator[KeyChange]:
+        """
+        yield the changes of a key in the version range [from_version, to_version]
+        in version order, the versions are read from the history bitmaps, the
+        values are resolved with one changeset multi_get per batch of versions.
+
+        the genesis state is not a change, it's the old value of the first one,
+        on a pruned db, the changes start after the pruned version.
+        """
+        # checked eagerly, before the iteration
+        if from_version is None:
+            from_version = self._pruned_version + 1 if self._pruned_version else 0
+        else:
+            self._check_pruned_changes(from_version)
+        return self._key_history(store_key, key, from_version, to_version, batch_size)
+
+    def _key_history(
+        self,
+        store_key: str,
+        key: bytes,
+        from_version: int,
+        to_version: Optional[int],
+        batch_size: int,
+    ) -> Iterator[KeyChange]:
+        snapshot = self.snapshot()
+        key = self.codec.full_key(store_key, key)
+
+        pending = []
+        next_version = None
+        for v in self._history_versions(key, from_version, snapshot.history):
+            if to_version is not None and v > to_version:
+                next_version = v
+                break
+            pending.append(v)
+            if len(pending) > batch_size:
+                # the extra one provides the new value of the last one
+                yield from self._resolve_key_history(
+                    key, pending[:-1], pending[-1], snapshot
+                )
+                pending = pending[-1:]
+        yield from self._resolve_key_history(key, pending, next_version, snapshot)
+
+    def _history_versions(self, key: bytes, from_version: int, snapshot=None):
+        "the versions >= from_version that changed the key, in the shards and bitmap"
+        opts = {"snapshot": snapshot} if snapshot is not None else {}
+        if self._sharded:
+            # the shards are keyed by the max version in them
+            prefix = shard_key_prefix(key)
+            it = self.history.iteritems(**opts)
+            it.seek(shard_key(key, from_version))
+            for k, v in it:
+                if k[:-8] != prefix:
+                    break
+                yield from iter_bitmap_from(decode_history(v), from_version)
+        v = self.history.get(key, **opts)
+        if v:
+            bounds = history_bounds(v)
+            if bounds is None or bounds[1] >= from_version:
+                yield from iter_bitmap_from(decode_history(v), from_version)
+
+    def _resolve_key_history(
+        self, key: bytes, versions: List[int], next_version: Optional[int], snapshot
+    ) -> Iterator[KeyChange]:
+        """
+        the changeset of a version is the value before it, which is also the value
+        after the previous one, the value after the last one is in plain state.
+        """
+        if not versions:
+            return
+        if next_version is not None:
+            versions = versions + [next_version]
+        keys = [changeset_key(v, key) for v in versions]
+        values = self.changeset.multi_get(keys, snapshot=snapshot.changeset)
+        olds = [values.get(k) or None for k in keys]
+        if next_version is None:
+            olds.append(self.plain.get(key, snapshot=snapshot.plain))
+        for i, v in enumerate(versions[: len(olds) - 1]):
+            yield KeyChange(v, olds[i], olds[i + 1])
+
+    def _scan_changeset(self, start: bytes, end: bytes):
+        "yield (version, full key, value) in the changeset key range"
+        it = self.changeset.iteritems()
+        it.seek(start)
+        for k, v in it:
+            if k >= end:
+                break
+            yield int.from_bytes(k[:8], "big"), k[8:], v
+
+    def pruned_version(self) -> int:
+        "the versions before it are pruned"
+        return self._pruned_version
+
+    def _check_pruned(self, version: Optional[int]):
+        if version is not None and version < self._pruned_version:
+            raise VersionPrunedError(
+                f"version {version} is pruned, "
+                f"the earliest version available is {self._pruned_version}"
+            )
+
+    def _check_pruned_changes(self, from_version: int):
+        """
+        the state at the pruned version is still available, but the changes of
+        it are not, its changeset is deleted with the earlier ones.
+        """
+        if self._pruned_version and from_version <= self._pruned_version:
+            raise VersionPrunedError(
+                f"the changes of version {from_version} are pruned, "
+                f"the earliest version available is {self._pruned_version + 1}"
+            )
+
+    def prune(self, before_version: int, batch_size: int = 10000) -> int:
+        """
+        delete the changesets and history only needed by the versions before
+        `before_version`, the queries on them fail with VersionPrunedError after.
+
+        it runs in bounded batches, the write lock is only held for one batch at
+        a time, so it can run in a thread next to the ingestion.
+
+        return the number of records deleted or trimmed.
+        """
+        latest = self.latest_version()
+        assert latest is not None and before_version <= latest, "prune the future"
+        if before_version <= self._pruned_version:
+            return 0
+
+        # record the marker first, so the queries fail clearly, instead of
+        # returning partially pruned history.
+        with self._write_lock:
+            with self.write_batches() as batches:
+                batches.plain.put(PRUNED_VERSION_KEY, encode_stdint64(before_version))
+            self._pruned_version = before_version
+
+        # the changesets at the versions <= before_version are never read by the
+        # versions >= before_version, they are contiguous at the beginning,
+        # after the ones deleted by the last prune.
+        v = self.plain.get(PRUNED_CHANGESETS_KEY)
+        cursor = changeset_key(decode_stdint64(v) + 1, b"") if v else b""
+        end = changeset_key(before_version + 1, b"")
+        # every version in the history bitmaps has its changeset record, so only
+        # the keys in the deleted changesets are trimmed. the dbs written before
+        # the creations are recorded scan the whole history instead.
+        incremental = self._changeset_creations
+        count = 0
+        while True:
+            keys = self._scan_keys(self.changeset, cursor, end, batch_size)
+            if not keys:
+                break
+            with self._write_lock:
+                history_keys = (
+                    self._history_keys({key[8:] for key in keys}, before_version)
+                    if incremental
+                    else []
+                )
+                with self.write_batches() as batches:
+                    for key in keys:
+                        batches.changeset.delete(key)
+                    count += len(keys)
+                    count += self._trim_history(
+                        history_keys, before_version, batches.history
+                    )
+                self._evict_bitmaps(history_keys)
+            cursor = keys[-1] + b"\x00"
+
+        if not incremental:
+            # trim the same versions from the history bitmaps and shards
+            cursor = b""
+            while True:
+                keys = self._scan_keys(self.history, cursor, None, batch_size)
+                if not keys:
+                    break
+                with self._write_lock:
+                    with self.write_batches() as batches:
+                        count += self._trim_history(
+                            keys, before_version, batches.history
+                        )
+                    self._evict_bitmaps(keys)
+                cursor = keys[-1] + b"\x00"
+
+        with self._write_lock:
+            with self.write_batches() as batches:
+                batches.plain.put(
+                    PRUNED_CHANGESETS_KEY, encode_stdint64(before_version)
+                )
+        return count
+
+    def upgrade_history(self, batch_size: int = 10000) -> int:
+        """
+        rewrite the history values in the old format with the header, the shards
+        included.
+
+        like prune, it runs in bounded batches, so it can run in a thread next to
+        the ingestion.
+
+        return the number of values rewritten.
+        """
+        count = 0
+        cursor = b""
+        while True:
+            keys = self._scan_keys(self.history, cursor, None, batch_size)
+            if not keys:
+                break
+            with self._write_lock:
+                # read the latest values again with the lock held
+                values = self.history.multi_get(keys)
+                with self.write_batches() as batches:
+                    for key, v in values.items():
+                        if v and history_bounds(v) is None:
+                            batches.history.put(key, encode_history(decode_history(v)))
+                            count += 1
+            cursor = keys[-1] + b"\x00"
+        return count
+
+    def _scan_keys(self, store, start: bytes, end: Optional[bytes], limit: int):
+        it = store.iteritems()
+        it.seek(start)
+        keys = []
+        for k, _ in it:
+            if (end is not None and k >= end) or len(keys) >= limit:
+                break
+            keys.append(k)
+        return keys
+
+    def _history_keys(self, keys: Iterable[bytes], before_version: int) -> List[bytes]:
+        "the history keys and the archived shards holding the versions before"
+        result = []
+        for key in sorted(keys):
+            result.append(key)
+            if not self._sharded:
+                continue
+            # the shards are keyed by the max version in them
+            prefix = shard_key_prefix(key)
+            it = self.history.iteritems()
+            it.seek(prefix)
+            for k, _ in it:
+                if k[:-8] != prefix:
+                    break
+                result.append(k)
+                if int.from_bytes(k[-8:], "big") >= before_version:
+                    break
+        return result
+
+    def _trim_history(self, keys: List[bytes], before_version: int, batch) -> int:
+        "called with the write lock held, read the latest values again"
+        count = 0
+        values = self.history.multi_get(keys) if keys else {}
+        for key, v in values.items():
+            if not v:
+                continue
+            bm = decode_history(v)
+            n = bm.rank(before_version)
+            if n == 0:
+                continue
+            count += 1
+            if n == len(bm):
+                batch.delete(key)
             else:
-                if not reverse:
-                    it.seek(prefix)
+                bm = BitMap64(bm[i] for i in range(n, len(bm)))
+                batch.put(key, encode_history(bm))
+        return count
+
+    def _evict_bitmaps(self, keys: List[bytes]):
+        "called after the trimmed history is committed"
+        if self.bitmap_cache is not None:
+            for key in keys:
+                self.bitmap_cache.pop(key)
+
+    def snapshot(self) -> Snapshot:
+        """
+        pin a consistent view of the stores for historical reads.
+
+        separate rocksdb instances are written in the order of changeset,
+        history, plain, so the snapshots are taken in the reverse order, then
+        changeset and history are at least as new as plain, the extra versions
+        in them don't change the result of the versions plain has reached.
+        """
+        if self.shared_db is not None:
+            snapshot = self.shared_db.snapshot()
+            return Snapshot(snapshot, snapshot, snapshot)
+        if not self._is_rocksdb:
+            # the lmdb stores share one read transaction
+            snapshot = self.plain.snapshot()
+            return Snapshot(snapshot, snapshot, snapshot)
+        plain = self.plain.snapshot()
+        history = self.history.snapshot()
+        changeset = self.changeset.snapshot()
+        return Snapshot(plain, changeset, history)
+
+    def checkpoint(self, dest) -> dict:
+        """
+        create a consistent copy of all the stores at one version in `dest`,
+        which must not exist, it can be opened like the original db, the
+        manifest records the version and is written last.
+
+        the rocksdb checkpoints hard link the sst files if `dest` is on the same
+        filesystem, the writes are paused between the blocks while they are
+        taken, which only flushes the memtables. lmdb is copied within a read
+        transaction, without pausing the writes.
+
+        return the manifest.
+        """
+        dest = Path(dest)
+        dest.mkdir(parents=True)
+        if not self._is_rocksdb:
+            layout = None
+            with self.plain.env.begin() as txn:
+                v = txn.get(LATEST_VERSION_KEY, db=self.plain.db)
+                # the copy is taken within the transaction only if compact
+                self.plain.env.copy(str(dest), compact=True, txn=txn)
+        else:
+            with self._write_lock:
+                v = self.plain.get(LATEST_VERSION_KEY)
+                if self.shared_db is not None:
+                    layout = LAYOUT_CF
+                    create_checkpoint(self.shared_db, dest / CF_DB_NAME)
                 else:
-                    it.seek_for_prev(incr_bytes(prefix))
-            return prefix_iteritems(it, prefix, reverse)
-        return VersionDBIter(self, version, store_key, start, reverse)
+                    layout = LAYOUT_SEPARATE
+                    for name in options.STORES:
+                        create_checkpoint(getattr(self, name), dest / f"{name}.db")
+
+        manifest = {
+            "version": decode_stdint64(v) if v is not None else None,
+            "backend": "rocksdb" if self._is_rocksdb else "lmdb",
+            "layout": layout,
+        }
+        tmp = dest / (CHECKPOINT_MANIFEST + ".tmp")
+        tmp.write_text(json.dumps(manifest, indent=2))
+        tmp.rename(dest / CHECKPOINT_MANIFEST)
+        return manifest
+
+
+def create_checkpoint(db: rocksdb.DB, path: Path):
+    "the sst files are hard linked, the memtables are flushed first"
+    rocksdb.Checkpoint(db).create_checkpoint(str(path))
+
+
+def detect_layout(path) -> str:
+    path = Path(path)
+    if (path / CF_DB_NAME).exists():
+        return LAYOUT_CF
+    return LAYOUT_SEPARATE